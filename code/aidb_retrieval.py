@@ -0,0 +1,63 @@
+# aidb retrievers return one JSON payload per hit, holding the image id. The products
+# row of every hit is joined in the same statement, in retrieval order, through
+# products_img_id_idx, so a search costs one round trip whatever k is. Hits without
+# a products row are skipped. The functions take a pooled SQLAlchemy connection and
+# run the statements prepared (see code/db_pool.py).
+
+from db_pool import execute_prepared
+
+IMAGE_DIR = "dataset/images"
+
+PRODUCTS_IMG_ID_INDEX = "CREATE INDEX IF NOT EXISTS products_img_id_idx ON products (img_id);"
+
+# Payload img_id values may carry a path; products stores the bare id. One products
+# row per hit, as products may hold the catalog more than once
+_HYDRATE = """
+    SELECT p.productdisplayname, p.img_id
+    FROM {source}
+    CROSS JOIN LATERAL (
+        SELECT productdisplayname, img_id FROM products
+        WHERE img_id = regexp_replace({img_id}, '^.*/', '')
+        LIMIT 1
+    ) p
+    ORDER BY r.ordinality;
+"""
+
+RETRIEVE_SQL = _HYDRATE.format(
+    source="aidb.retrieve(%(query)s, %(k)s, %(retriever)s) WITH ORDINALITY AS r",
+    img_id="r.data::jsonb ->> 'img_id'",
+)
+RETRIEVE_VIA_S3_SQL = _HYDRATE.format(
+    source="aidb.retrieve_via_s3(%(retriever)s, %(k)s, %(bucket)s, %(image_name)s, %(endpoint)s) WITH ORDINALITY AS r",
+    img_id="r.data::jsonb ->> 'img_id'",
+)
+HYDRATE_SQL = _HYDRATE.format(
+    source="unnest(%(img_ids)s::text[]) WITH ORDINALITY AS r(img_id, ordinality)",
+    img_id="r.img_id",
+)
+
+
+def _products(result):
+    return [
+        {"name": name, "image_path": f"{IMAGE_DIR}/{img_id}.jpg"}
+        for name, img_id in result.fetchall()
+    ]
+
+
+def retrieve_products(connection, query, k, retriever_name):
+    """Top-k products for a text query as {name, image_path} dicts."""
+    return _products(execute_prepared(connection, RETRIEVE_SQL, {"query": query, "k": k, "retriever": retriever_name}))
+
+
+def retrieve_products_via_s3(connection, retriever_name, k, bucket_name, image_name, endpoint=""):
+    """Top-k products for an image stored in the retriever's S3 bucket."""
+    return _products(execute_prepared(
+        connection,
+        RETRIEVE_VIA_S3_SQL,
+        {"retriever": retriever_name, "k": k, "bucket": bucket_name, "image_name": image_name, "endpoint": endpoint},
+    ))
+
+
+def hydrate_products(connection, img_ids):
+    """{name, image_path} dicts for image ids retrieved elsewhere (e.g. a vector store driver), in order."""
+    return _products(execute_prepared(connection, HYDRATE_SQL, {"img_ids": list(img_ids)}))
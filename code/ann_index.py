@@ -0,0 +1,461 @@
+import argparse
+import contextlib
+import hashlib
+import math
+import re
+import threading
+import time
+
+import psycopg2
+
+TABLE = "products_emb"
+COLUMN = "embedding"
+METHODS = ("hnsw", "ivfflat")
+EMBEDDING_DIM = 512
+DEFAULT_MAX_MAINTENANCE_WORK_MEM_MB = 2048
+# Filtered searches mostly restrict masterCategory, so that is the column partial indexes are built on
+PARTITION_COLUMN = "mastercategory"
+DEFAULT_PARTIAL_INDEX_MIN_ROWS = 1000
+FILTER_COLUMNS = ("mastercategory", "gender", "articletype", "season")
+# Stored embeddings are L2-normalized, so searches order by negative inner product (<#>),
+# which ranks like cosine distance without normalizing both vectors on every comparison
+NORM_TOLERANCE = 1e-3
+# full: inner product on the stored embeddings. binary: Hamming distance on the
+# binary-quantized signatures, then exact re-ranking (see binary_quantization.py)
+SEARCH_MODES = ("full", "binary")
+BINARY_COLUMN = "embedding_bq"
+DEFAULT_BINARY_CANDIDATES = 100
+
+
+def index_name(method, column=COLUMN):
+    return f"{TABLE}_{column}_{method}_idx"
+
+
+def _opclass(cursor, column):
+    # The operator class follows the column's storage type, vector or halfvec
+    # (see compact_storage.py), and the distance its searches order by
+    cursor.execute(
+        "SELECT t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+        "WHERE a.attrelid = %s::regclass AND a.attname = %s;",
+        (TABLE, column),
+    )
+    typname = cursor.fetchone()[0]
+    # Binary signatures (see binary_quantization.py) are compared by Hamming distance
+    if typname == "bit":
+        return "bit_hamming_ops"
+    # The normalized embeddings by inner product; PCA-reduced copies are centered, not unit length
+    return f"{typname}_ip_ops" if column == COLUMN else f"{typname}_cosine_ops"
+
+
+def _create_db_connection():
+    return psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+
+
+def choose_build_params(method, rows):
+    """Index build parameters for a table of `rows` vectors, following the pgvector guidance.
+
+    IVFFlat: rows / 1000 lists up to 1M rows, sqrt(rows) beyond. HNSW: the
+    defaults (m=16, ef_construction=64) for catalogs of this size, with a
+    wider construction beam and more links as the table grows.
+    """
+    if method == "ivfflat":
+        lists = max(1, rows // 1000) if rows <= 1_000_000 else int(math.sqrt(rows))
+        return {"lists": lists}
+    if method == "hnsw":
+        if rows < 100_000:
+            return {"m": 16, "ef_construction": 64}
+        if rows < 1_000_000:
+            return {"m": 16, "ef_construction": 128}
+        return {"m": 24, "ef_construction": 200}
+    raise ValueError(f"Unknown index method {method!r}, expected one of {METHODS}")
+
+
+def recommended_search_params(method, build_params):
+    """Starting point for the per-query setting; raise it for recall, lower it for speed."""
+    if method == "ivfflat":
+        return {"ivfflat.probes": max(1, round(math.sqrt(build_params["lists"])))}
+    return {"hnsw.ef_search": 40}
+
+
+def _estimate_build_memory_mb(method, rows, params):
+    # HNSW builds fastest when the whole graph fits in maintenance_work_mem:
+    # each element holds its vector plus up to 2m neighbor slots on layer 0
+    per_row = 4 * EMBEDDING_DIM + 64
+    if method == "hnsw":
+        per_row += 2 * params["m"] * 8
+    return math.ceil(rows * per_row * 1.2 / (1024 * 1024))
+
+
+def _report_progress(progress_conn, pid, done, interval):
+    with progress_conn.cursor() as cursor:
+        while not done.wait(interval):
+            cursor.execute(
+                "SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total "
+                "FROM pg_stat_progress_create_index WHERE pid = %s;",
+                (pid,),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                continue
+            phase, blocks_done, blocks_total, tuples_done, tuples_total = row
+            if tuples_total:
+                print(f"Index build: {phase}, {tuples_done}/{tuples_total} tuples ({100 * tuples_done / tuples_total:.1f}%)")
+            elif blocks_total:
+                print(f"Index build: {phase}, {blocks_done}/{blocks_total} blocks ({100 * blocks_done / blocks_total:.1f}%)")
+            else:
+                print(f"Index build: {phase}")
+
+
+def _build_index(conn, name, method, rows, predicate=None, concurrently=False, progress_conn=None,
+                 progress_interval=5, max_maintenance_work_mem_mb=DEFAULT_MAX_MAINTENANCE_WORK_MEM_MB,
+                 parallel_workers=None, column=COLUMN):
+    """Create index `name` on `column` over `rows` vectors, optionally partial on (column, value) `predicate`."""
+    start_time = time.time()
+    params = choose_build_params(method, rows)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT setting::bigint / 1024 FROM pg_settings WHERE name = 'maintenance_work_mem';")
+        current_mb = cursor.fetchone()[0]
+        wanted_mb = min(_estimate_build_memory_mb(method, rows, params), max_maintenance_work_mem_mb)
+        if wanted_mb > current_mb:
+            cursor.execute(f"SET maintenance_work_mem = '{wanted_mb}MB';")
+        if parallel_workers is not None:
+            cursor.execute("SET max_parallel_maintenance_workers = %s;", (parallel_workers,))
+
+        target = f"{name}_new" if concurrently else name
+        concurrent = "CONCURRENTLY " if concurrently else ""
+        # Leftover of an interrupted concurrent build, or the index being replaced
+        cursor.execute(f"DROP INDEX {concurrent}IF EXISTS {target};")
+        options = ", ".join(f"{key} = {value}" for key, value in params.items())
+        statement = f"CREATE INDEX {concurrent}{target} ON {TABLE} USING {method} ({column} {_opclass(cursor, column)}) WITH ({options})"
+        statement_params = None
+        if predicate is not None:
+            # psycopg2 inlines the value, and the planner only uses a partial index
+            # for queries whose WHERE clause implies this literal predicate
+            statement += f" WHERE {predicate[0]} = %s"
+            statement_params = (predicate[1],)
+        print(f"Building {name} on {rows} rows with {options}, maintenance_work_mem {max(wanted_mb, current_mb)}MB")
+
+        done = threading.Event()
+        reporter = None
+        if progress_conn is not None:
+            reporter = threading.Thread(
+                target=_report_progress,
+                args=(progress_conn, conn.get_backend_pid(), done, progress_interval),
+                daemon=True,
+            )
+            reporter.start()
+        try:
+            cursor.execute(statement + ";", statement_params)
+        finally:
+            done.set()
+            if reporter is not None:
+                reporter.join()
+
+        if concurrently:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+            cursor.execute(f"ALTER INDEX {target} RENAME TO {name};")
+        cursor.execute("RESET maintenance_work_mem;")
+        cursor.execute("RESET max_parallel_maintenance_workers;")
+
+    settings = ", ".join(f"{key} = {value}" for key, value in recommended_search_params(method, params).items())
+    print(f"Built {name} in {time.time() - start_time:.1f} seconds; suggested search setting: {settings}")
+    return params
+
+
+@contextlib.contextmanager
+def _autocommit(conn):
+    """Run the block with autocommit on, then restore the caller's setting.
+
+    psycopg2 only changes the setting outside a transaction, so a transaction
+    the caller left open (e.g. after ann_index_status) is committed first,
+    as drop_ann_indexes does.
+    """
+    if conn.autocommit:
+        yield
+        return
+    if conn.status != psycopg2.extensions.STATUS_READY:
+        conn.commit()
+    conn.autocommit = True
+    try:
+        yield
+    finally:
+        if conn.status == psycopg2.extensions.STATUS_READY:
+            conn.autocommit = False
+
+
+def build_ann_index(conn, method="hnsw", concurrently=False, progress_conn=None, progress_interval=5,
+                    max_maintenance_work_mem_mb=DEFAULT_MAX_MAINTENANCE_WORK_MEM_MB, parallel_workers=None,
+                    column=COLUMN):
+    """(Re)build the `method` ANN index on products_emb.`column`, sized from the table.
+
+    Run it after a bulk load: building once over all rows is much faster than
+    maintaining the index row by row while loading. With `concurrently`, the
+    new index is built next to the old one and swapped in, so searches keep
+    using an index throughout. With `progress_conn` (a second connection),
+    pg_stat_progress_create_index is printed every `progress_interval`
+    seconds. Returns the build parameters used.
+    """
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction block
+    with _autocommit(conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {TABLE} WHERE {column} IS NOT NULL;")
+            rows = cursor.fetchone()[0]
+        params = _build_index(conn, index_name(method, column), method, rows, None, concurrently, progress_conn,
+                              progress_interval, max_maintenance_work_mem_mb, parallel_workers, column)
+        with conn.cursor() as cursor:
+            cursor.execute(f"ANALYZE {TABLE};")
+    return params
+
+
+def partial_index_name(method, value):
+    """Name of the `method` index restricted to one PARTITION_COLUMN value, within the 63-byte limit."""
+    slug = re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_")
+    name = f"{TABLE}_{COLUMN}_{method}_cat_{slug}_idx"
+    if len(name) > 63:
+        digest = hashlib.sha1(value.encode()).hexdigest()[:8]
+        name = f"{TABLE}_{COLUMN}_{method}_cat_{slug[:63 - len(TABLE) - len(COLUMN) - len(method) - 20]}_{digest}_idx"
+    return name
+
+
+def build_partial_indexes(conn, method="hnsw", min_rows=DEFAULT_PARTIAL_INDEX_MIN_ROWS, concurrently=False,
+                          progress_conn=None, progress_interval=5,
+                          max_maintenance_work_mem_mb=DEFAULT_MAX_MAINTENANCE_WORK_MEM_MB, parallel_workers=None):
+    """Build one partial ANN index per masterCategory with at least `min_rows` products.
+
+    A search filtered on masterCategory then walks a graph (or lists) holding
+    only that category, instead of walking the whole catalog and discarding
+    most candidates. Smaller categories are left to the btree filter index,
+    where an exact scan of a few hundred rows is cheaper than any ANN index.
+    Partial indexes of categories that disappeared or shrank below
+    `min_rows` are dropped. Returns {category: build parameters}.
+    """
+    with _autocommit(conn):
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {PARTITION_COLUMN}, count(*) FROM {TABLE} "
+                f"WHERE {COLUMN} IS NOT NULL AND {PARTITION_COLUMN} IS NOT NULL GROUP BY 1 ORDER BY 2 DESC;"
+            )
+            categories = [(value, rows) for value, rows in cursor.fetchall() if rows >= min_rows]
+        wanted = {partial_index_name(method, value) for value, _ in categories}
+        prefix = f"{TABLE}_{COLUMN}_{method}_cat_"
+        with conn.cursor() as cursor:
+            for name, *_ in ann_index_status(conn):
+                if name.startswith(prefix) and name not in wanted:
+                    cursor.execute(f"DROP INDEX IF EXISTS {name};")
+        built = {}
+        for value, rows in categories:
+            built[value] = _build_index(conn, partial_index_name(method, value), method, rows, (PARTITION_COLUMN, value),
+                                        concurrently, progress_conn, progress_interval, max_maintenance_work_mem_mb,
+                                        parallel_workers)
+        with conn.cursor() as cursor:
+            cursor.execute(f"ANALYZE {TABLE};")
+    return built
+
+
+def drop_ann_indexes(conn, methods=METHODS, column=COLUMN):
+    """Drop the managed ANN indexes on `column`, full and per-category, e.g. before a full reload."""
+    prefixes = tuple(f"{TABLE}_{column}_{method}_" for method in methods)
+    with conn.cursor() as cursor:
+        for name, *_ in ann_index_status(conn):
+            if name.startswith(prefixes):
+                cursor.execute(f"DROP INDEX IF EXISTS {name};")
+    if not conn.autocommit:
+        conn.commit()
+
+
+def ann_index_status(conn):
+    """Return (name, method, valid, size, options, predicate, rows) for every ANN index on products_emb."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, am.amname, i.indisvalid, pg_size_pretty(pg_relation_size(c.oid)),
+                   array_to_string(c.reloptions, ', '), pg_get_expr(i.indpred, i.indrelid), t.reltuples::bigint
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE t.relname = %s AND am.amname IN ('hnsw', 'ivfflat')
+            ORDER BY c.relname;
+            """,
+            (TABLE,),
+        )
+        return cursor.fetchall()
+
+
+def normalize_embeddings(conn, tolerance=NORM_TOLERANCE):
+    """One-off backfill: L2-normalize stored embeddings and rebuild indexes built for cosine distance.
+
+    Rows loaded before embeddings were normalized on ingestion rank wrongly
+    by inner product; only rows whose squared norm is off by more than
+    `tolerance` are rewritten. ANN indexes on embedding still using the
+    cosine operator class are rebuilt with the inner-product one. Returns
+    the number of rows updated.
+    """
+    start_time = time.time()
+    with _autocommit(conn):
+        with conn.cursor() as cursor:
+            # -(v <#> v) is the squared norm, for vector and halfvec alike
+            cursor.execute(
+                f"UPDATE {TABLE} SET {COLUMN} = l2_normalize({COLUMN}) "
+                f"WHERE {COLUMN} IS NOT NULL AND abs(-({COLUMN} <#> {COLUMN}) - 1) > %s;",
+                (tolerance,),
+            )
+            updated = cursor.rowcount
+            cursor.execute(f"VACUUM ANALYZE {TABLE};")
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexdef LIKE %s;",
+                (TABLE, "%_cosine_ops%"),
+            )
+            outdated = {row[0] for row in cursor.fetchall()}
+        print(f"Normalized {updated} embeddings")
+        for method in METHODS:
+            if index_name(method) in outdated:
+                build_ann_index(conn, method)
+            if any(name.startswith(f"{TABLE}_{COLUMN}_{method}_cat_") for name in outdated):
+                build_partial_indexes(conn, method)
+    print(f"Backfill done in {time.time() - start_time:.1f} seconds")
+    return updated
+
+
+def validate_filters(filters):
+    """Return {column: value} for the non-empty attribute filters, rejecting unknown columns.
+
+    Column names are interpolated into the search SQL, so only FILTER_COLUMNS
+    are accepted; values are always bound as parameters.
+    """
+    filters = {column.lower(): value for column, value in (filters or {}).items() if value not in (None, "")}
+    unknown = set(filters) - set(FILTER_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unsupported filter columns {sorted(unknown)}, expected some of {FILTER_COLUMNS}")
+    return filters
+
+
+def similarity_query(vector, limit, filters=None, mode="full", candidates=DEFAULT_BINARY_CANDIDATES):
+    """Return (sql, params) selecting id, productdisplayname, image_path and cosine distance of the `limit` nearest products.
+
+    Parameters use the psycopg2 pyformat style. `vector` is the query
+    embedding, L2-normalized like the stored ones: a float32 NumPy array on
+    a connection with pgvector.psycopg2.register_vector applied,
+    or pgvector text. The order is by inner product (<#>), computed once per
+    row in a subquery; the distance is 1 + (a <#> b). In binary mode the
+    `candidates` nearest signatures by Hamming distance are re-ranked by
+    exact inner product; hnsw.ef_search must be at least `candidates` for
+    the index to return that many.
+    """
+    filters = validate_filters(filters)
+    where = " AND ".join(f"{column} = %({column})s" for column in filters)
+    where = f"WHERE {where}" if where else ""
+    params = {"vector": vector, "limit": limit, **filters}
+    if mode == "full":
+        # Ordering by the output column still walks the ANN index
+        sql = f"""
+            SELECT id, productdisplayname, image_path, 1 + inner_product AS distance
+            FROM (
+                SELECT id, productdisplayname, image_path, embedding <#> %(vector)s AS inner_product
+                FROM {TABLE}
+                {where}
+                ORDER BY inner_product
+                LIMIT %(limit)s
+            ) nearest
+            ORDER BY inner_product;
+        """
+    elif mode == "binary":
+        # The untyped literal takes the embedding column's type (vector or halfvec);
+        # binary_quantize needs an explicit one, and either gives the same bits. It
+        # is bound twice so that, prepared, each parameter gets its own type
+        sql = f"""
+            SELECT id, productdisplayname, image_path, 1 + inner_product AS distance
+            FROM (
+                SELECT id, productdisplayname, image_path, embedding <#> %(vector)s AS inner_product
+                FROM (
+                    SELECT id, productdisplayname, image_path, embedding
+                    FROM {TABLE}
+                    {where}
+                    ORDER BY {BINARY_COLUMN} <~> binary_quantize(CAST(%(signature)s AS vector))::bit({EMBEDDING_DIM})
+                    LIMIT %(candidates)s
+                ) candidates
+            ) scored
+            ORDER BY inner_product
+            LIMIT %(limit)s;
+        """
+        params["signature"] = vector
+        params["candidates"] = candidates
+    else:
+        raise ValueError(f"Unknown search mode {mode!r}, expected one of {SEARCH_MODES}")
+    return sql, params
+
+
+def search_settings(ef_search=None, probes=None, filters=None):
+    """Per-query ANN settings as {GUC: value}; None keeps the server setting.
+
+    ef_search is the HNSW candidate list size and must be at least the LIMIT
+    to return LIMIT rows; probes is the number of IVFFlat lists scanned.
+    With a masterCategory filter a prepared search (see code/db_pool.py) is
+    planned for the bound value every time, as a generic plan cannot choose
+    that category's partial index.
+    """
+    settings = {}
+    if PARTITION_COLUMN in validate_filters(filters):
+        settings["plan_cache_mode"] = "force_custom_plan"
+    if ef_search is not None:
+        settings["hnsw.ef_search"] = str(int(ef_search))
+    if probes is not None:
+        settings["ivfflat.probes"] = str(int(probes))
+    return settings
+
+
+def set_search_params(cursor, ef_search=None, probes=None, filters=None):
+    """Apply search_settings for the current transaction only (SET LOCAL semantics)."""
+    for name, value in search_settings(ef_search, probes, filters).items():
+        cursor.execute("SELECT set_config(%s, %s, true);", (name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the ANN indexes on products_emb.embedding.")
+    parser.add_argument("command", choices=("build", "drop", "status", "normalize"),
+                        help="normalize: one-off L2 normalization of stored embeddings, rebuilding cosine indexes")
+    parser.add_argument("--method", choices=METHODS, default="hnsw")
+    parser.add_argument("--per-category", help="build one partial index per masterCategory instead of one over the whole table", action="store_true")
+    parser.add_argument("--min-rows", help="smallest category that gets its own partial index", type=int, default=DEFAULT_PARTIAL_INDEX_MIN_ROWS)
+    parser.add_argument("--concurrently", help="build next to the current index and swap, without blocking searches or writes", action="store_true")
+    parser.add_argument("--parallel-workers", help="max_parallel_maintenance_workers for the build", type=int, default=None)
+    parser.add_argument("--max-maintenance-work-mem-mb", help="upper bound for the build's maintenance_work_mem", type=int, default=DEFAULT_MAX_MAINTENANCE_WORK_MEM_MB)
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    conn.autocommit = True
+    try:
+        if args.command == "build":
+            progress_conn = _create_db_connection()
+            progress_conn.autocommit = True
+            try:
+                if args.per_category:
+                    build_partial_indexes(conn, args.method, args.min_rows, args.concurrently, progress_conn,
+                                          max_maintenance_work_mem_mb=args.max_maintenance_work_mem_mb,
+                                          parallel_workers=args.parallel_workers)
+                else:
+                    build_ann_index(conn, args.method, args.concurrently, progress_conn,
+                                    max_maintenance_work_mem_mb=args.max_maintenance_work_mem_mb,
+                                    parallel_workers=args.parallel_workers)
+            finally:
+                progress_conn.close()
+        elif args.command == "drop":
+            drop_ann_indexes(conn, (args.method,))
+        elif args.command == "normalize":
+            normalize_embeddings(conn)
+        else:
+            for name, method, valid, size, options, predicate, rows in ann_index_status(conn):
+                where = f" WHERE {predicate}" if predicate else ""
+                print(f"{name}: {method}, {'valid' if valid else 'INVALID'}, {size}, ({options}){where}, table ~{rows} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import time
 import argparse
 import psycopg2
 import app_search_aidb_singleclick  # Import the second page
+from aidb_retrieval import PRODUCTS_IMG_ID_INDEX
 
 def _create_db_connection():
         """Create and return a database connection."""
@@ -34,6 +35,8 @@ def initialize_database(conn):
                 productDisplayName TEXT NULL
             );
         """)
+        # Retrieval results are joined to products on img_id
+        cur.execute(PRODUCTS_IMG_ID_INDEX)
     conn.commit()
 
 def create_and_refresh_retriever(conn, retriever_name, s3_bucket_name, s3_public_url):
@@ -0,0 +1,270 @@
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+import psycopg2
+import torch
+from pgvector.psycopg2 import register_vector
+from transformers import CLIPTokenizer
+
+from ann_index import TABLE, set_search_params, validate_filters
+from clip_model import MODEL_NAME, PRECISIONS, encode_images, encode_texts, load_clip_model
+from compact_storage import embedding_type
+from embedding_client import EmbeddingClient
+from image_loader import DECODE_ERRORS, decode_image
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_ENCODE_BATCH_SIZE = 64
+
+
+def _create_db_connection():
+    conn = psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+    # Query vectors are bound as NumPy arrays
+    register_vector(conn)
+    return conn
+
+
+class BatchEncoder:
+    """Encode many texts or images in batched CLIP forward passes.
+
+    Uses a local model, or the embedding server at `embedding_server` (see
+    embedding_server.py) when given. Embeddings are L2-normalized float32.
+    """
+
+    def __init__(self, precision="fp32", weights_dir=None, embedding_server=None, batch_size=DEFAULT_ENCODE_BATCH_SIZE):
+        self.batch_size = batch_size
+        if embedding_server:
+            self.client = EmbeddingClient(embedding_server)
+            self.model = self.tokenizer = None
+        else:
+            self.client = None
+            self.model = load_clip_model(precision, weights_dir=weights_dir)
+            self.tokenizer = CLIPTokenizer.from_pretrained(MODEL_NAME)
+
+    def encode_texts(self, texts):
+        """Return a (len(texts), 512) array."""
+        chunks = []
+        for offset in range(0, len(texts), self.batch_size):
+            batch = list(texts[offset:offset + self.batch_size])
+            if self.client is not None:
+                chunks.append(self.client.encode_texts(batch))
+            else:
+                chunks.append(encode_texts(self.model, self.tokenizer, batch).numpy())
+        return np.concatenate(chunks) if chunks else np.empty((0, 512), dtype=np.float32)
+
+    def encode_images(self, images):
+        """Encode image file bytes; returns a list with None for undecodable images."""
+        embeddings = []
+        for offset in range(0, len(images), self.batch_size):
+            batch = images[offset:offset + self.batch_size]
+            if self.client is not None:
+                embeddings.extend(self.client.encode_images(batch))
+                continue
+            pixels, decoded = [], []
+            for data in batch:
+                try:
+                    pixels.append(decode_image(data))
+                    decoded.append(True)
+                except DECODE_ERRORS:
+                    decoded.append(False)
+            computed = iter(encode_images(self.model, torch.from_numpy(np.stack(pixels))).numpy() if pixels else [])
+            embeddings.extend(next(computed) if ok else None for ok in decoded)
+        return embeddings
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+def _filter_clause(filters, alias):
+    return "".join(f" AND {alias}.{column} = %({column})s" for column in filters)
+
+
+def batch_similarity_query(vectors, limit, filters=None, vector_type="vector"):
+    """Return (sql, params) for the `limit` nearest products of every vector, in one statement.
+
+    The query vectors are unnested from one array parameter and each drives
+    its own index scan through a LATERAL join. Rows are (query, id,
+    productdisplayname, image_path, distance), query being the position in
+    `vectors`. The vectors are bound as float32 NumPy arrays, so the
+    connection needs pgvector.psycopg2.register_vector applied.
+    `vector_type` is the type of products_emb.embedding: the array needs an
+    explicit cast to it, unlike the untyped literal of
+    ann_index.similarity_query.
+    """
+    if vector_type not in ("vector", "halfvec"):
+        raise ValueError(f"Unsupported embedding column type {vector_type!r}")
+    filters = validate_filters(filters)
+    sql = f"""
+        SELECT q.ord - 1, r.id, r.productdisplayname, r.image_path, r.distance
+        FROM unnest(%(vectors)s::{vector_type}[]) WITH ORDINALITY AS q(vector, ord)
+        CROSS JOIN LATERAL (
+            SELECT e.id, e.productdisplayname, e.image_path, 1 + (e.embedding <#> q.vector) AS distance
+            FROM {TABLE} e
+            WHERE e.embedding IS NOT NULL{_filter_clause(filters, "e")}
+            ORDER BY e.embedding <#> q.vector
+            LIMIT %(limit)s
+        ) r
+        ORDER BY q.ord, r.distance;
+    """
+    params = {"vectors": list(np.asarray(vectors, dtype=np.float32)), "limit": limit, **filters}
+    return sql, params
+
+
+def lookalikes_query(product_ids, limit, filters=None):
+    """Return (sql, params) for the `limit` nearest other products of each stored product.
+
+    The query embeddings are read in the database, so nothing is encoded or
+    shipped. Rows are (query product id, id, productdisplayname, image_path,
+    distance).
+    """
+    filters = validate_filters(filters)
+    sql = f"""
+        SELECT q.id, r.id, r.productdisplayname, r.image_path, r.distance
+        FROM {TABLE} q
+        CROSS JOIN LATERAL (
+            SELECT e.id, e.productdisplayname, e.image_path, 1 + (e.embedding <#> q.embedding) AS distance
+            FROM {TABLE} e
+            WHERE e.id <> q.id{_filter_clause(filters, "e")}
+            ORDER BY e.embedding <#> q.embedding
+            LIMIT %(limit)s
+        ) r
+        WHERE q.id = ANY(%(ids)s) AND q.embedding IS NOT NULL
+        ORDER BY q.id, r.distance;
+    """
+    return sql, {"ids": list(product_ids), "limit": limit, **filters}
+
+
+def _execute(conn, sql, params, ef_search, k):
+    with conn.cursor() as cursor:
+        # Transaction-local, and the HNSW scan has to return k rows per query
+        set_search_params(cursor, ef_search=max(ef_search or 0, k))
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    conn.commit()
+    return rows
+
+
+def _result(product_id, name, image_path, distance):
+    return {"id": product_id, "name": name, "image_path": image_path, "distance": distance}
+
+
+def search_vectors(conn, vectors, k=10, filters=None, ef_search=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Top-k products of each query vector, one statement per `chunk_size` vectors.
+
+    Returns one list per vector of {id, name, image_path, distance} dicts:
+    the rows of get_similarity_results plus their distance. `conn` needs
+    pgvector.psycopg2.register_vector applied, as _create_db_connection does.
+    """
+    with conn.cursor() as cursor:
+        vector_type = embedding_type(cursor)
+    conn.commit()
+    results = [[] for _ in range(len(vectors))]
+    for offset in range(0, len(vectors), chunk_size):
+        sql, params = batch_similarity_query(vectors[offset:offset + chunk_size], k, filters, vector_type)
+        for query, *row in _execute(conn, sql, params, ef_search, k):
+            results[offset + query].append(_result(*row))
+    return results
+
+
+def search_texts(conn, encoder, texts, k=10, filters=None, ef_search=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """search_vectors for text queries, encoded in batches first."""
+    return search_vectors(conn, encoder.encode_texts(texts), k, filters, ef_search, chunk_size)
+
+
+def search_images(conn, encoder, images, k=10, filters=None, ef_search=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """search_vectors for image file bytes; undecodable images get None instead of a result list."""
+    embeddings = encoder.encode_images(images)
+    decoded = [index for index, embedding in enumerate(embeddings) if embedding is not None]
+    results = [None] * len(images)
+    if decoded:
+        found = search_vectors(conn, np.stack([embeddings[index] for index in decoded]), k, filters, ef_search, chunk_size)
+        for index, rows in zip(decoded, found):
+            results[index] = rows
+    return results
+
+
+def search_lookalikes(conn, product_ids, k=10, filters=None, ef_search=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """{product id: top-k other products} for stored products, e.g. a nightly lookalike feed."""
+    results = {}
+    product_ids = list(product_ids)
+    for offset in range(0, len(product_ids), chunk_size):
+        sql, params = lookalikes_query(product_ids[offset:offset + chunk_size], k, filters)
+        for query, *row in _execute(conn, sql, params, ef_search, k):
+            results.setdefault(query, []).append(_result(*row))
+    return results
+
+
+def _write_rows(output, queries, results):
+    writer = csv.writer(output)
+    writer.writerow(["query", "rank", "id", "productdisplayname", "image_path", "distance"])
+    for query, rows in zip(queries, results):
+        for rank, row in enumerate(rows or [], 1):
+            writer.writerow([query, rank, row["id"], row["name"], row["image_path"], f"{row['distance']:.6f}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer many similarity searches in a few round trips; writes CSV.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--texts", help="file with one text query per line")
+    source.add_argument("--images", help="image files to search with", nargs="+")
+    source.add_argument("--product-ids", help="file with one product id per line, searched with their stored embeddings")
+    source.add_argument("--all-products", help="lookalikes of every embedded product", action="store_true")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--chunk-size", help="queries per SQL statement", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--ef-search", help="hnsw.ef_search (at least --k)", type=int, default=None)
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--weights-dir", help="shared weights written by shared_weights.py", default=None)
+    parser.add_argument("--embedding-server", help="encode through embedding_server.py at this address", default=None)
+    parser.add_argument("--output", help="CSV file (default: stdout)", default=None)
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        start_time = time.time()
+        if args.texts or args.images:
+            encoder = BatchEncoder(args.precision, args.weights_dir, args.embedding_server)
+            try:
+                if args.texts:
+                    with open(args.texts) as f:
+                        queries = [line.strip() for line in f if line.strip()]
+                    results = search_texts(conn, encoder, queries, args.k, ef_search=args.ef_search, chunk_size=args.chunk_size)
+                else:
+                    queries = args.images
+                    images = []
+                    for path in queries:
+                        with open(path, "rb") as f:
+                            images.append(f.read())
+                    results = search_images(conn, encoder, images, args.k, ef_search=args.ef_search, chunk_size=args.chunk_size)
+            finally:
+                encoder.close()
+        else:
+            if args.all_products:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"SELECT id FROM {TABLE} WHERE embedding IS NOT NULL ORDER BY id;")
+                    queries = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+            else:
+                with open(args.product_ids) as f:
+                    queries = [int(line) for line in f if line.strip()]
+            found = search_lookalikes(conn, queries, args.k, ef_search=args.ef_search, chunk_size=args.chunk_size)
+            results = [found.get(product_id) for product_id in queries]
+        _write_rows(output, queries, results)
+        print(f"Answered {len(queries)} queries in {time.time() - start_time:.1f} seconds", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
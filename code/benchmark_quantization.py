@@ -0,0 +1,151 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import CLIPTokenizer
+
+import image_loader
+from clip_model import MODEL_NAME, PRECISIONS, encode_images, encode_texts, load_clip_model
+
+DEFAULT_QUERIES = [
+    "red shoes",
+    "red women shoes",
+    "black shoes",
+    "blue jeans",
+    "white t-shirt",
+    "men watch",
+    "leather handbag",
+    "sports sandals",
+    "floral dress",
+    "sunglasses",
+]
+
+
+def _percentile(values, pct):
+    return float(np.percentile(np.array(values), pct))
+
+
+def _top_k(queries, catalog, k):
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    scores = queries @ catalog.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def _overlap(a, b):
+    return float(np.mean([len(set(x) & set(y)) / len(x) for x, y in zip(a, b)]))
+
+
+def benchmark_precision(precision, pixels, queries, tokenizer, batch, latency_runs):
+    """Embed the image sample and the queries with one model variant and time it."""
+    load_start = time.time()
+    model = load_clip_model(precision)
+    load_time = time.time() - load_start
+
+    encode_images(model, torch.from_numpy(pixels[:batch]))  # Warm-up
+    start = time.time()
+    image_embeddings = [
+        encode_images(model, torch.from_numpy(pixels[i:i + batch])).numpy()
+        for i in range(0, len(pixels), batch)
+    ]
+    image_time = time.time() - start
+
+    text_latencies = []
+    for _ in range(latency_runs):
+        for query in queries:
+            start = time.time()
+            encode_texts(model, tokenizer, [query])
+            text_latencies.append(time.time() - start)
+
+    image_latencies = []
+    for i in range(min(latency_runs * len(queries), len(pixels))):
+        start = time.time()
+        encode_images(model, torch.from_numpy(pixels[i:i + 1]))
+        image_latencies.append(time.time() - start)
+
+    return {
+        "precision": precision,
+        "load_time": load_time,
+        "images_per_second": len(pixels) / image_time,
+        "text_p50_ms": _percentile(text_latencies, 50) * 1000,
+        "text_p95_ms": _percentile(text_latencies, 95) * 1000,
+        "image_p50_ms": _percentile(image_latencies, 50) * 1000,
+        "image_p95_ms": _percentile(image_latencies, 95) * 1000,
+        "image_embeddings": np.concatenate(image_embeddings),
+        "text_embeddings": encode_texts(model, tokenizer, queries).numpy(),
+    }
+
+
+def format_report(results, sample_size, queries, k, batch):
+    """Markdown table of `results`; the first one is the reference for speedup, overlap and cosine."""
+    baseline = results[0]
+    reference = baseline["precision"]
+    lines = [
+        f"# CLIP inference precision report ({MODEL_NAME})",
+        "",
+        f"{sample_size} catalog images, batch {batch}, {len(queries)} text queries, "
+        f"{torch.get_num_threads()} torch threads on {os.cpu_count()} cores. "
+        f"Speedup, overlap and cosine are relative to {reference}.",
+        "",
+        "| precision | load (s) | images/s | speedup | text p50 (ms) | text p95 (ms) | image p50 (ms) | image p95 (ms) "
+        f"| text→image top-{k} overlap | image→image top-{k} overlap | mean cosine to {reference} |",
+        "|---|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    catalog = baseline["image_embeddings"]
+    text_ref = _top_k(baseline["text_embeddings"], catalog, k)
+    probes = catalog[: min(100, len(catalog))]
+    image_ref = _top_k(probes, catalog, k)
+    for result in results:
+        embeddings = result["image_embeddings"]
+        text_overlap = _overlap(text_ref, _top_k(result["text_embeddings"], embeddings, k))
+        image_overlap = _overlap(image_ref, _top_k(embeddings[: len(probes)], embeddings, k))
+        cosine = float(np.mean(np.sum(embeddings * catalog, axis=1)))
+        lines.append(
+            f"| {result['precision']} | {result['load_time']:.2f} | {result['images_per_second']:.1f} "
+            f"| {result['images_per_second'] / baseline['images_per_second']:.2f}x "
+            f"| {result['text_p50_ms']:.1f} | {result['text_p95_ms']:.1f} "
+            f"| {result['image_p50_ms']:.1f} | {result['image_p95_ms']:.1f} "
+            f"| {text_overlap:.3f} | {image_overlap:.3f} | {cosine:.4f} |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32 and quantized CLIP inference on the fashion dataset.")
+    parser.add_argument("--images", help="directory with the catalog images", default="dataset/images")
+    parser.add_argument("--sample", help="number of catalog images to embed", type=int, default=2000)
+    parser.add_argument("--batch", help="images per forward pass", type=int, default=32)
+    parser.add_argument("--k", help="neighbours compared for top-k overlap", type=int, default=10)
+    parser.add_argument("--latency-runs", help="repetitions of the per-query latency measurement", type=int, default=5)
+    parser.add_argument("--precisions", nargs="+", choices=PRECISIONS, default=list(PRECISIONS))
+    parser.add_argument("--output", help="write the markdown report to this file", default=None)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))[: args.sample]
+    pixels = []
+    for path in paths:
+        try:
+            pixels.append(image_loader.load_image(path))
+        except image_loader.DECODE_ERRORS as e:
+            print(f"Failed to process image {path}: {e}")
+    pixels = np.stack(pixels)
+    tokenizer = CLIPTokenizer.from_pretrained(MODEL_NAME)
+
+    # fp32 always runs, first: it is the reference for the speedup and overlap columns
+    precisions = ["fp32"] + [precision for precision in args.precisions if precision != "fp32"]
+    results = []
+    for precision in precisions:
+        print(f"Benchmarking {precision}...")
+        results.append(benchmark_precision(precision, pixels, DEFAULT_QUERIES, tokenizer, args.batch, args.latency_runs))
+
+    report = format_report(results, len(pixels), DEFAULT_QUERIES, args.k, args.batch)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import time
+
+import numpy as np
+import psycopg2
+
+from ann_index import (
+    BINARY_COLUMN,
+    DEFAULT_BINARY_CANDIDATES,
+    EMBEDDING_DIM,
+    METHODS,
+    SEARCH_MODES,
+    TABLE,
+    build_ann_index,
+    drop_ann_indexes,
+    set_search_params,
+    similarity_query,
+)
+
+
+def _create_db_connection():
+    return psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+
+
+def install_binary_signatures(conn, ann_method="hnsw"):
+    """Add the embedding_bq signature column (one sign bit per dimension) and its Hamming-distance index.
+
+    It is a stored generated column, so every loader (INSERT, binary COPY,
+    load_fashion_tag) keeps it in step with embedding without changes.
+    """
+    start_time = time.time()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS {BINARY_COLUMN} bit({EMBEDDING_DIM}) "
+            f"GENERATED ALWAYS AS (binary_quantize(embedding)::bit({EMBEDDING_DIM})) STORED;"
+        )
+        cursor.execute(f"VACUUM ANALYZE {TABLE};")
+    if ann_method:
+        build_ann_index(conn, ann_method, column=BINARY_COLUMN)
+    print(f"Installed binary signatures in {time.time() - start_time:.1f} seconds")
+
+
+def remove_binary_signatures(conn):
+    conn.autocommit = True
+    drop_ann_indexes(conn, column=BINARY_COLUMN)
+    with conn.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} DROP COLUMN IF EXISTS {BINARY_COLUMN};")
+
+
+def has_binary_signatures(cursor):
+    cursor.execute(
+        "SELECT 1 FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped;",
+        (TABLE, BINARY_COLUMN),
+    )
+    return cursor.fetchone() is not None
+
+
+def _sample_queries(cursor, queries, seed):
+    cursor.execute("SELECT setseed(%s);", (seed / 2 ** 31,))
+    cursor.execute(f"SELECT id, embedding::text FROM {TABLE} WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s;", (queries,))
+    return cursor.fetchall()
+
+
+def _search(cursor, vector, k, exclude, mode, candidates, ef_search, exact=False):
+    # One more than k, since the query is a catalog item and finds itself
+    sql, params = similarity_query(vector, k + 1, mode=mode, candidates=candidates)
+    if exact:
+        # The reference: a sequential scan computing every distance
+        cursor.execute("SET LOCAL enable_indexscan = off;")
+    else:
+        set_search_params(cursor, ef_search=max(ef_search, candidates) if mode == "binary" else ef_search)
+    start_time = time.perf_counter()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    elapsed = time.perf_counter() - start_time
+    cursor.connection.rollback()
+    return [row[0] for row in rows if row[0] != exclude][:k], elapsed
+
+
+def benchmark(conn, k=10, queries=200, candidates=DEFAULT_BINARY_CANDIDATES, ef_search=40, seed=0):
+    """Recall@k against an exact scan and latency of each search mode, with catalog items as queries.
+
+    Returns rows (mode, recall, p50 ms, p95 ms).
+    """
+    # SET LOCAL needs a transaction; an autocommit connection is idle, so it can switch
+    if conn.autocommit:
+        conn.autocommit = False
+    with conn.cursor() as cursor:
+        sample = _sample_queries(cursor, queries, seed)
+        conn.rollback()
+        reference = {product_id: _search(cursor, vector, k, product_id, "full", candidates, ef_search, exact=True)[0]
+                     for product_id, vector in sample}
+        results = []
+        for mode in SEARCH_MODES:
+            recalls, latencies = [], []
+            for product_id, vector in sample:
+                found, elapsed = _search(cursor, vector, k, product_id, mode, candidates, ef_search)
+                expected = reference[product_id]
+                recalls.append(len(set(found) & set(expected)) / len(expected) if expected else 1.0)
+                latencies.append(elapsed * 1000)
+            label = f"binary + re-rank top {candidates}" if mode == "binary" else "full"
+            results.append((label, float(np.mean(recalls)), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))))
+    return results
+
+
+def format_report(results, queries, k, ef_search):
+    lines = [
+        "# Binary quantization benchmark",
+        "",
+        f"{queries} catalog items as queries, recall@{k} against an exact scan, hnsw.ef_search = {ef_search}.",
+        "",
+        f"| mode | recall@{k} | p50 ms | p95 ms |",
+        "|---|---|---|---|",
+    ]
+    for mode, recall, p50, p95 in results:
+        lines.append(f"| {mode} | {recall:.3f} | {p50:.2f} | {p95:.2f} |")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage and benchmark the binary-quantized signatures of products_emb.embedding.")
+    parser.add_argument("command", choices=("install", "drop", "benchmark"),
+                        help="install: add embedding_bq and its index; drop: remove them; "
+                             "benchmark: recall and latency of the full and binary search modes")
+    parser.add_argument("--ann-index", help="ANN index to build on embedding_bq", choices=METHODS + ("none",), default="hnsw")
+    parser.add_argument("--k", help="neighbors compared for recall@k", type=int, default=10)
+    parser.add_argument("--queries", help="catalog items used as queries", type=int, default=200)
+    parser.add_argument("--candidates", help="Hamming candidates re-ranked with the full embedding", type=int, default=DEFAULT_BINARY_CANDIDATES)
+    parser.add_argument("--ef-search", help="hnsw.ef_search of the full mode (binary uses at least --candidates)", type=int, default=40)
+    parser.add_argument("--output", help="write the markdown report to this file", default=None)
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    try:
+        if args.command == "install":
+            install_binary_signatures(conn, None if args.ann_index == "none" else args.ann_index)
+        elif args.command == "drop":
+            remove_binary_signatures(conn)
+        else:
+            with conn.cursor() as cursor:
+                if not has_binary_signatures(cursor):
+                    parser.error("products_emb has no embedding_bq column; run the install command first")
+            conn.rollback()
+            results = benchmark(conn, args.k, args.queries, args.candidates, args.ef_search)
+            report = format_report(results, args.queries, args.k, args.ef_search)
+            print(report)
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(report)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import torch
+from transformers import CLIPModel
+
+MODEL_NAME = "openai/clip-vit-base-patch32"
+EMBEDDING_DIM = 512
+
+# fp32: the published weights. int8: dynamic quantization of every nn.Linear
+# (weights stored as int8, activations quantized on the fly), which covers
+# the bulk of the transformer FLOPs and needs no calibration data.
+PRECISIONS = ("fp32", "int8")
+
+
+def load_clip_model(precision="fp32", model_name=MODEL_NAME, weights_dir=None):
+    """Load CLIP in eval mode for CPU inference at the given precision.
+
+    With `weights_dir` (written by shared_weights.py), fp32 weights are mapped
+    read-only from disk and shared with every other process mapping them.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    if weights_dir:
+        from shared_weights import load_shared_model
+
+        model = load_shared_model(weights_dir)
+    else:
+        model = CLIPModel.from_pretrained(model_name)
+    model.eval()
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def model_key(precision="fp32", model_name=MODEL_NAME):
+    """Identify a model variant, e.g. for embedding cache namespaces."""
+    return model_name if precision == "fp32" else f"{model_name}:{precision}"
+
+
+def encode_images(model, pixel_values):
+    """Return normalized CLIP image_embeds using only the vision tower and projection."""
+    # Towers are called directly: get_image_features returns a tensor or a
+    # model output object depending on the transformers version
+    with torch.no_grad():
+        image_embeds = model.visual_projection(model.vision_model(pixel_values=pixel_values).pooler_output)
+    # Same normalization CLIPModel.forward applies to its image_embeds output
+    return image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+
+
+def encode_texts(model, tokenizer, texts):
+    """Return normalized CLIP text_embeds using only the text tower and projection."""
+    inputs = tokenizer(texts, padding=True, truncation=True, return_tensors="pt")
+    with torch.no_grad():
+        text_embeds = model.text_projection(model.text_model(**inputs).pooler_output)
+    return text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
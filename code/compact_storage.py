@@ -0,0 +1,286 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import psycopg2
+
+from ann_index import BINARY_COLUMN, METHODS, ann_index_status, build_ann_index, build_partial_indexes, drop_ann_indexes
+from binary_quantization import has_binary_signatures, install_binary_signatures, remove_binary_signatures
+
+TABLE = "products_emb"
+PROJECTION_NAME = "products_emb_pca"
+PCA_COLUMN = "embedding_pca"
+EMBEDDING_DIM = 512
+SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sql", "compact_storage.sql")
+
+
+def _create_db_connection():
+    return psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+
+
+def vector_bytes(dim, bytes_per_component):
+    # pgvector stores an int16 dimension and an unused int16 ahead of the components,
+    # inside a varlena with a 4-byte header
+    return 4 + 4 + dim * bytes_per_component
+
+
+def embedding_type(cursor, column="embedding"):
+    cursor.execute(
+        "SELECT t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+        "WHERE a.attrelid = %s::regclass AND a.attname = %s AND NOT a.attisdropped;",
+        (TABLE, column),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def fetch_embeddings(conn, batch=5000):
+    """Return (ids, (N, 512) float32 embeddings) of every embedded product."""
+    ids, vectors = [], []
+    with conn.cursor(name="compact_storage_embeddings") as cursor:
+        # Text form works for both vector and halfvec columns
+        cursor.execute(f"SELECT id, embedding::text FROM {TABLE} WHERE embedding IS NOT NULL ORDER BY id;")
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for product_id, text in rows:
+                ids.append(product_id)
+                vectors.append(np.fromstring(text[1:-1], dtype=np.float32, sep=","))
+    conn.commit()
+    return np.array(ids), np.stack(vectors)
+
+
+def fit_pca(embeddings, dim, sample=None, seed=0):
+    """Fit a `dim`-component PCA; returns (mean, components (dim, 512), explained variance ratio)."""
+    if sample and sample < len(embeddings):
+        embeddings = embeddings[np.random.default_rng(seed).choice(len(embeddings), sample, replace=False)]
+    mean = embeddings.mean(axis=0)
+    _, singular_values, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    variance = singular_values ** 2
+    return mean.astype(np.float32), vt[:dim].astype(np.float32), float(variance[:dim].sum() / variance.sum())
+
+
+def _top_k(queries, catalog, k, exclude):
+    # Stored embeddings are unit length, so the dot product ranks like cosine similarity
+    scores = queries @ catalog.T
+    # A query is a catalog item; leave it out of its own neighbors
+    scores[np.arange(len(exclude)), exclude] = -np.inf
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def _rerank(queries, catalog, candidates, k):
+    reranked = []
+    for query, rows in zip(queries, candidates):
+        scores = catalog[rows] @ query
+        reranked.append(rows[np.argsort(-scores)[:k]])
+    return np.array(reranked)
+
+
+def _recall(reference, result):
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(reference, result)]))
+
+
+def compare_storage(embeddings, dims, k=10, queries=500, candidates=100, sample=None, seed=0):
+    """Recall@k of each storage mode against exact fp32 search, with catalog items as queries.
+
+    halfvec rounds both sides to float16, as pgvector does when a query is
+    compared with a halfvec column. PCA modes project with a fit on the
+    catalog, search the reduced float16 vectors, and optionally re-rank the
+    top `candidates` with the full halfvec embedding.
+    """
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(embeddings), min(queries, len(embeddings)), replace=False)
+    reference = _top_k(embeddings[query_rows], embeddings, k, query_rows)
+
+    results = [("vector (fp32)", vector_bytes(EMBEDDING_DIM, 4), 1.0, None)]
+    half = embeddings.astype(np.float16).astype(np.float32)
+    results.append(("halfvec", vector_bytes(EMBEDDING_DIM, 2), _recall(reference, _top_k(half[query_rows], half, k, query_rows)), None))
+    for dim in dims:
+        mean, components, explained = fit_pca(embeddings, dim, sample, seed)
+        reduced = ((embeddings - mean) @ components.T).astype(np.float16).astype(np.float32)
+        # embedding_pca is searched by cosine distance: the reduced vectors are centered, not unit length
+        reduced /= np.linalg.norm(reduced, axis=1, keepdims=True)
+        found = _top_k(reduced[query_rows], reduced, max(k, candidates), query_rows)
+        results.append((f"PCA {dim} (halfvec)", vector_bytes(dim, 2), _recall(reference, found[:, :k]), explained))
+        reranked = _rerank(half[query_rows], half, found, k)
+        results.append((f"PCA {dim} + re-rank top {candidates}", vector_bytes(dim, 2), _recall(reference, reranked), explained))
+    return results
+
+
+def format_report(results, rows, queries, k):
+    lines = [
+        "# Embedding storage comparison",
+        "",
+        f"{rows} products, {queries} catalog items as queries, recall@{k} against exact fp32 cosine search.",
+        "",
+        f"| storage | bytes per vector | recall@{k} | explained variance |",
+        "|---|---|---|---|",
+    ]
+    for mode, size, recall, explained in results:
+        explained = "" if explained is None else f"{explained:.3f}"
+        lines.append(f"| {mode} | {size} | {recall:.3f} | {explained} |")
+    return "\n".join(lines) + "\n"
+
+
+def _existing_ann_indexes(conn, column="embedding"):
+    """(methods with a full index, methods with per-category indexes) on `column`, to rebuild after a type change."""
+    full, partial = set(), set()
+    for name, method, *_ in ann_index_status(conn):
+        if name.startswith(f"{TABLE}_{column}_{method}_cat_"):
+            partial.add(method)
+        elif name == f"{TABLE}_{column}_{method}_idx":
+            full.add(method)
+    return full, partial
+
+
+def _has_pca_trigger(cursor):
+    cursor.execute(
+        "SELECT 1 FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = 'products_emb_pca';",
+        (TABLE,),
+    )
+    return cursor.fetchone() is not None
+
+
+def _create_pca_trigger(cursor):
+    # Tied to the embedding column, so convert_embedding_column drops and recreates it around a type change
+    cursor.execute(
+        f"CREATE TRIGGER products_emb_pca BEFORE INSERT OR UPDATE OF embedding ON {TABLE} "
+        f"FOR EACH ROW EXECUTE FUNCTION products_emb_project_pca();"
+    )
+
+
+def convert_embedding_column(conn, target):
+    """Change products_emb.embedding to `target` ("halfvec" or "vector") in place, rebuilding its ANN indexes.
+
+    The indexes are dropped first (their operator class depends on the type)
+    and rebuilt with the same methods afterwards, as are the generated
+    embedding_bq signature column and the products_emb_pca trigger, which
+    both block type changes. embedding_pca keeps its values: pca_project
+    reads the text form of either type. Going back from halfvec to vector
+    does not restore the precision lost in the conversion.
+    """
+    start_time = time.time()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        current = embedding_type(cursor)
+        if current == target:
+            print(f"products_emb.embedding is already {target}")
+            return
+        full, partial = _existing_ann_indexes(conn)
+        binary = has_binary_signatures(cursor)
+        binary_full, _ = _existing_ann_indexes(conn, BINARY_COLUMN)
+        pca_trigger = _has_pca_trigger(cursor)
+        if binary:
+            remove_binary_signatures(conn)
+        if pca_trigger:
+            cursor.execute(f"DROP TRIGGER products_emb_pca ON {TABLE};")
+        drop_ann_indexes(conn)
+        print(f"Converting products_emb.embedding from {current} to {target}...")
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN embedding TYPE {target}({EMBEDDING_DIM}) USING embedding::{target}({EMBEDDING_DIM});")
+        if pca_trigger:
+            _create_pca_trigger(cursor)
+        cursor.execute(f"VACUUM ANALYZE {TABLE};")
+    for method in METHODS:
+        if method in full:
+            build_ann_index(conn, method)
+        if method in partial:
+            build_partial_indexes(conn, method)
+    if binary:
+        install_binary_signatures(conn, min(binary_full) if binary_full else None)
+    print(f"Converted in {time.time() - start_time:.1f} seconds")
+
+
+def install_pca(conn, dim, sample=None, ann_method="hnsw"):
+    """Fit a PCA projection on the catalog and maintain a reduced halfvec(dim) copy of every embedding.
+
+    The projection is stored in embedding_projections; a trigger fills
+    embedding_pca for rows any loader writes afterwards.
+    """
+    start_time = time.time()
+    ids, embeddings = fetch_embeddings(conn)
+    mean, components, explained = fit_pca(embeddings, dim, sample)
+    print(f"Fitted {dim} components on {min(sample or len(ids), len(ids))} embeddings, explaining {explained:.3f} of the variance")
+
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TRIGGER IF EXISTS products_emb_pca ON {TABLE};")
+        drop_ann_indexes(conn, column=PCA_COLUMN)
+        # The reduced dimension may have changed; the column is recomputed below anyway
+        cursor.execute(f"ALTER TABLE {TABLE} DROP COLUMN IF EXISTS {PCA_COLUMN};")
+        cursor.execute(f"ALTER TABLE {TABLE} ADD COLUMN {PCA_COLUMN} halfvec({dim});")
+        with open(SQL_PATH) as f:
+            cursor.execute(f.read())
+        cursor.execute(
+            """
+            INSERT INTO embedding_projections (name, dim_in, dim_out, mean, components, explained_variance, fitted_rows, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, clock_timestamp())
+            ON CONFLICT (name) DO UPDATE
+            SET dim_in = EXCLUDED.dim_in, dim_out = EXCLUDED.dim_out, mean = EXCLUDED.mean, components = EXCLUDED.components,
+                explained_variance = EXCLUDED.explained_variance, fitted_rows = EXCLUDED.fitted_rows, created_at = EXCLUDED.created_at;
+            """,
+            (PROJECTION_NAME, EMBEDDING_DIM, dim, mean.tolist(), components.ravel().tolist(), explained, min(sample or len(ids), len(ids))),
+        )
+        cursor.execute(f"UPDATE {TABLE} SET {PCA_COLUMN} = public.pca_project(embedding::text);")
+        _create_pca_trigger(cursor)
+        cursor.execute(f"VACUUM ANALYZE {TABLE};")
+    if ann_method:
+        build_ann_index(conn, ann_method, column=PCA_COLUMN)
+    print(f"Installed PCA storage in {time.time() - start_time:.1f} seconds")
+
+
+def remove_pca(conn):
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TRIGGER IF EXISTS products_emb_pca ON {TABLE};")
+        cursor.execute(f"ALTER TABLE {TABLE} DROP COLUMN IF EXISTS {PCA_COLUMN};")
+        cursor.execute("DELETE FROM embedding_projections WHERE name = %s;", (PROJECTION_NAME,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare and migrate the storage of products_emb embeddings.")
+    parser.add_argument("command", choices=("compare", "halfvec", "vector", "pca", "drop-pca"),
+                        help="compare: recall of each mode against fp32; halfvec / vector: convert embedding in place; "
+                             "pca: add a PCA-reduced embedding_pca column; drop-pca: remove it")
+    parser.add_argument("--dims", help="PCA dimensions to compare", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--dim", help="PCA dimension to install", type=int, default=128)
+    parser.add_argument("--sample", help="embeddings used to fit the PCA (default: all)", type=int, default=None)
+    parser.add_argument("--k", help="neighbors compared for recall@k", type=int, default=10)
+    parser.add_argument("--queries", help="catalog items used as queries", type=int, default=500)
+    parser.add_argument("--candidates", help="PCA candidates re-ranked with the full embedding", type=int, default=100)
+    parser.add_argument("--ann-index", help="ANN index to build on embedding_pca", choices=METHODS + ("none",), default="hnsw")
+    parser.add_argument("--output", help="write the markdown report to this file", default=None)
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    try:
+        if args.command == "compare":
+            with conn.cursor() as cursor:
+                if embedding_type(cursor) != "vector":
+                    print("Note: embedding is already stored as halfvec, so the reference is the halfvec values, not fp32")
+            _, embeddings = fetch_embeddings(conn)
+            results = compare_storage(embeddings, args.dims, args.k, args.queries, args.candidates, args.sample)
+            report = format_report(results, len(embeddings), min(args.queries, len(embeddings)), args.k)
+            print(report)
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(report)
+        elif args.command in ("halfvec", "vector"):
+            convert_embedding_column(conn, args.command)
+        elif args.command == "pca":
+            install_pca(conn, args.dim, args.sample, None if args.ann_index == "none" else args.ann_index)
+        else:
+            remove_pca(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
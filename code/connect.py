@@ -1,10 +1,22 @@
+import argparse
+import multiprocessing
 import os
+import queue
+import threading
 import time
-from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import torch
 import numpy as np
 import psycopg2
 import pandas as pd
+import image_loader
+from ann_index import METHODS, ann_index_status, build_ann_index, build_partial_indexes, drop_ann_indexes, index_name
+from clip_model import EMBEDDING_DIM, PRECISIONS, encode_images, load_clip_model, model_key
+from embedding_cache import EmbeddingCache, image_digest
+from embedding_client import EmbeddingClient
+from pgvector_copy import copy_products_emb
+from thumbnail_store import ThumbnailStore, build_thumbnails
 from sqlalchemy import create_engine, text
 
 def _create_db_connection():
@@ -17,76 +29,400 @@ def _create_db_connection():
         port=15432
     )
 
-def load_fashion_tag(base_path, tag, batch, conn):
+PRODUCTS_QUERY = """
+    SELECT p.id, p.gender, p.mastercategory, p.subcategory, p.articletype, p.basecolour, p.season, p.year, p.usage, p.productdisplayname
+    FROM products p
+    WHERE (%(low)s::int IS NULL OR p.id >= %(low)s) AND (%(high)s::int IS NULL OR p.id <= %(high)s)
+"""
+
+# Anti-join: skip products that already have an embedding with identical attributes
+PENDING_FILTER = """
+    AND NOT EXISTS (
+        SELECT 1 FROM products_emb e
+        WHERE e.id = p.id
+          AND (e.gender, e.mastercategory, e.subcategory, e.articletype, e.basecolour, e.season, e.year, e.usage, e.productdisplayname)
+              IS NOT DISTINCT FROM
+              (p.gender, p.mastercategory, p.subcategory, p.articletype, p.basecolour, p.season, p.year, p.usage, p.productdisplayname))
+"""
+
+# Sentinel pushed through the pipeline queues to signal that a stage is done.
+_DONE = object()
+
+def load_fashion_tag(base_path, tag=None, batch=32, conn=None, decode_workers=4, queue_size=8, id_range=None, incremental=False, cache_dir=None, precision="fp32", weights_dir=None, embedding_server=None):
+    """Embed every row of products into products_emb with a staged pipeline.
+
+    A thread pool decodes and preprocesses image batches, the calling thread
+    runs CLIP inference, and a writer thread streams the embeddings into
+    products_emb with binary COPY. Stages are connected by bounded queues so
+    decoding and inserting overlap with inference without buffering the whole
+    catalog in memory.
+
+    Only the CLIP vision tower runs, so `tag` is no longer needed; it is kept
+    for callers that still pass it. A connection is opened (and closed) here
+    when `conn` is not given. `id_range` restricts the load to products whose
+    id lies in the inclusive (low, high) range. Returns the number of rows
+    inserted.
+
+    Every batch is committed as its own transaction. With `incremental`, only
+    products missing from products_emb or whose attributes changed are
+    embedded (stale rows are replaced), so rerunning after an interruption
+    resumes after the last committed batch.
+
+    With `cache_dir`, embeddings are looked up in an EmbeddingCache keyed by
+    the image bytes, model and preprocessing, and only cache misses are
+    decoded and run through CLIP. `precision` selects fp32 or dynamically
+    quantized int8 inference and `weights_dir` loads CLIP from weights
+    exported by shared_weights.py (see clip_model.load_clip_model). With
+    `embedding_server` (see embedding_server.py), preprocessed images are
+    sent to that server instead of running a model in this process.
+    """
+    if conn is None:
+        conn = _create_db_connection()
+        conn.autocommit = True
+        try:
+            return load_fashion_tag(base_path, tag, batch, conn, decode_workers, queue_size, id_range, incremental, cache_dir, precision, weights_dir, embedding_server)
+        finally:
+            conn.close()
+
     # Initialize timing variables for overall function performance tracking
     function_start_time = time.time()
 
-    # Load the model and processor with timing
-    model_loading_start = time.time()
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    model_loading_end = time.time()
+    cache = None
+    if cache_dir:
+        if embedding_server:
+            # The server's model encodes the misses, whatever `precision` says here
+            client = EmbeddingClient(embedding_server)
+            try:
+                served = client.metrics()
+            finally:
+                client.close()
+            key = model_key(served["precision"], served["model"])
+        else:
+            key = model_key(precision)
+        cache = EmbeddingCache(cache_dir, key, image_loader.PREPROCESS_VERSION)
+    # The model is loaded on the first cache miss, so a fully cached rebuild never loads it
+    model = None
+    model_loading_time = 0
 
     fetch_start = time.time()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname FROM products;")
-    result = cursor.fetchall()
+    # Server-side cursor: rows are fetched one batch at a time, so client memory
+    # does not grow with the catalog. WITH HOLD lets it outlive the per-batch
+    # commits of the writer; the server keeps the result until it is closed.
+    cursor = conn.cursor(name="fashion_products", withhold=True)
+    query = PRODUCTS_QUERY
+    if incremental:
+        query += PENDING_FILTER
+    low, high = id_range or (None, None)
+    cursor.execute(query + " ORDER BY p.id;", {"low": low, "high": high})
+    embedding_type = _embedding_column_type(conn)
+    if not conn.autocommit:
+        conn.commit()  # End the read transaction before the writer starts its own
     fetch_end = time.time()
 
-    batch_size = batch
-    total_rows_inserted = 0
+    # The decoder (fetching) and the writer share conn; never interleave their statements
+    conn_lock = threading.Lock()
+    batches = _fetch_batches(cursor, batch, conn_lock)
+
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    stats = {"rows_inserted": 0, "insert_time": 0.0}
+
+    decoder = threading.Thread(
+        target=_decode_stage,
+        args=(batches, base_path, cache, decoded_queue, decode_workers, stop, errors),
+        name="fashion-decode",
+        daemon=True,
+    )
+    writer = threading.Thread(
+        target=_write_stage,
+        args=(conn, conn_lock, write_queue, stats, errors, incremental, embedding_type),
+        name="fashion-write",
+        daemon=True,
+    )
+    decoder.start()
+    writer.start()
+
     total_image_processing_time = 0
+    try:
+        while True:
+            item = decoded_queue.get()
+            if item is _DONE:
+                break
+            if errors:
+                # A stage failed and later batches would be dropped; stop embedding the rest
+                stop.set()
+                while decoded_queue.get() is not _DONE:
+                    pass
+                break
+            valid_rows, valid_paths, digests, embeddings, cached, inputs = item
+            if not valid_rows:
+                continue
+            if inputs is not None:
+                if model is None:
+                    # Load the model with timing; images are preprocessed by image_loader
+                    model_loading_start = time.time()
+                    if embedding_server:
+                        model = EmbeddingClient(embedding_server)
+                    else:
+                        model = load_clip_model(precision, weights_dir=weights_dir)
+                    model_loading_time = time.time() - model_loading_start
+                image_processing_start_time = time.time()
+                if embedding_server:
+                    computed = model.encode_pixels(inputs["pixel_values"].numpy())
+                else:
+                    computed = encode_images(model, inputs["pixel_values"]).cpu().numpy()
+                total_image_processing_time += time.time() - image_processing_start_time
+                embeddings[~cached] = computed
+                if cache is not None:
+                    cache.put_many([digest for digest, hit in zip(digests, cached) if not hit], computed)
+            write_queue.put((valid_rows, valid_paths, embeddings))
+    except BaseException:
+        # Unblock the decoder so it can observe the stop flag and exit.
+        stop.set()
+        while decoded_queue.get() is not _DONE:
+            pass
+        raise
+    finally:
+        write_queue.put(_DONE)
+        writer.join()
+        decoder.join()
+        with conn_lock:
+            cursor.close()
+        if cache is not None:
+            cache.close()
+        if embedding_server and model is not None:
+            model.close()
 
-    for i in range(0, 50, batch_size):
-        batch_ids = [row[0] for row in result[i:i+batch_size]]
-        inputs, valid_paths = load_images_batch(batch_ids, base_path, processor, tag)
-        if inputs is not None:
-            image_processing_start_time = time.time()
-            outputs = model(**inputs)
-            image_processing_end_time = time.time()
-            embeddings = outputs.image_embeds
-            image_processing_time = image_processing_end_time - image_processing_start_time
-            total_image_processing_time += image_processing_time
-
-            embeddings_list = embeddings.detach().cpu().numpy().tolist()
-
-            with conn.cursor() as cursor:
-                for idx, embedding in enumerate(embeddings_list):
-                    row = result[i + idx]
-                    image_path = valid_paths[idx]
-                    cursor.execute(
-                        "INSERT INTO products_emb (id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname, image_path, embedding) "
-                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                        (row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], image_path, embedding)
-                    )
-                    total_rows_inserted += 1
+    if errors:
+        raise errors[0]
 
     function_end_time = time.time()
     total_time = function_end_time - function_start_time
+    total_rows_inserted = stats["rows_inserted"]
     print(f"Total Rows: {total_rows_inserted}")
     print(f"Total function execution time: {total_time} seconds")
-    print(f"Model loading time: {model_loading_end - model_loading_start} seconds")
+    print(f"Model loading time: {model_loading_time} seconds")
     print(f"Fetching time: {fetch_end - fetch_start} seconds")
+    print(f"Inference time: {total_image_processing_time} seconds")
+    print(f"Insert time: {stats['insert_time']} seconds")
+    if cache is not None:
+        print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses")
+    if total_time > 0:
+        print(f"Throughput: {total_rows_inserted / total_time:.1f} images/second")
+    return total_rows_inserted
+
+def load_fashion_tag_sharded(base_path, batch=32, workers=None, threads_per_worker=None, decode_workers=2, incremental=False, cache_dir=None, precision="fp32", weights_dir=None, embedding_server=None):
+    """Embed products with `workers` processes, each owning a model and a disjoint id range.
+
+    Batch-32 CLIP inference stops scaling after a few intra-op threads, so a
+    big host is better used by several independent pipelines than by one
+    wide one. Failed shards are reported with their id ranges once every
+    other shard has finished, and a RuntimeError is raised; rerunning with
+    `incremental` picks them up where they stopped.
+    """
+    start_time = time.time()
+    workers = workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // workers)
+
+    conn = _create_db_connection()
+    try:
+        shards = _shard_id_ranges(conn, workers)
+    finally:
+        conn.close()
+    if not shards:
+        print("No products to embed")
+        return 0
+
+    total_rows_inserted = 0
+    failures = []
+    # spawn, not fork: torch's thread pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as executor:
+        futures = {
+            executor.submit(_ingest_shard, base_path, batch, id_range, threads_per_worker, decode_workers, incremental, cache_dir, precision, weights_dir, embedding_server): id_range
+            for id_range in shards
+        }
+        for future in as_completed(futures):
+            id_range = futures[future]
+            try:
+                rows, elapsed = future.result()
+            except Exception as e:
+                failures.append((id_range, e))
+                print(f"Shard {id_range[0]}-{id_range[1]} failed: {e}")
+                continue
+            total_rows_inserted += rows
+            print(f"Shard {id_range[0]}-{id_range[1]}: {rows} rows in {elapsed:.1f} seconds ({rows / elapsed:.1f} images/second)")
 
-def load_images_batch(batch_ids, base_path, processor, tag):
-    images, valid_paths = [], []
-    for image_id in batch_ids:
-        image_path = f"{base_path}/{image_id}.jpg"
+    total_time = time.time() - start_time
+    print(f"Total Rows: {total_rows_inserted} with {len(shards)} workers x {threads_per_worker} threads")
+    print(f"Total sharded execution time: {total_time} seconds")
+    if total_time > 0:
+        print(f"Throughput: {total_rows_inserted / total_time:.1f} images/second")
+    if failures:
+        ranges = ", ".join(f"{low}-{high}" for (low, high), _ in failures)
+        raise RuntimeError(f"{len(failures)} shard(s) failed, id ranges: {ranges}") from failures[0][1]
+    return total_rows_inserted
+
+def _shard_id_ranges(conn, workers):
+    """Split products into at most `workers` inclusive id ranges of similar row counts."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT min(id), max(id) FROM (SELECT id, ntile(%s) OVER (ORDER BY id) AS shard FROM products) s "
+            "GROUP BY shard ORDER BY shard;",
+            (workers,),
+        )
+        return [tuple(row) for row in cursor.fetchall()]
+
+def _ingest_shard(base_path, batch, id_range, threads, decode_workers, incremental, cache_dir, precision, weights_dir, embedding_server):
+    """Worker process entry point: embed one id range with its own model and connection."""
+    torch.set_num_threads(threads)
+    start_time = time.time()
+    rows = load_fashion_tag(base_path, None, batch, None, decode_workers, id_range=id_range, incremental=incremental, cache_dir=cache_dir, precision=precision, weights_dir=weights_dir, embedding_server=embedding_server)
+    return rows, time.time() - start_time
+
+def _fetch_batches(cursor, batch_size, conn_lock):
+    """Yield batches of rows from a server-side cursor."""
+    while True:
+        with conn_lock:
+            rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+def _decode_stage(batches, base_path, cache, decoded_queue, workers, stop, errors):
+    """Decode batches on a thread pool, keeping at most `workers` batches in flight."""
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fashion-decode") as executor:
+            pending = deque()
+            for rows in batches:
+                if stop.is_set():
+                    break
+                pending.append(executor.submit(load_images_batch, rows, base_path, cache))
+                if len(pending) >= workers:
+                    decoded_queue.put(pending.popleft().result())
+            while pending and not stop.is_set():
+                decoded_queue.put(pending.popleft().result())
+    except Exception as e:
+        errors.append(e)
+    finally:
+        decoded_queue.put(_DONE)
+
+def _embedding_column_type(conn):
+    """'vector' or 'halfvec', depending on the storage mode of products_emb.embedding (see compact_storage.py)."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid "
+            "WHERE a.attrelid = 'products_emb'::regclass AND a.attname = 'embedding';"
+        )
+        return cursor.fetchone()[0]
+
+def _write_stage(conn, conn_lock, write_queue, stats, errors, replace, embedding_type):
+    """COPY embedded batches into products_emb until the pipeline is drained."""
+    while True:
+        item = write_queue.get()
+        if item is _DONE:
+            break
+        if errors:
+            continue  # Keep draining so the inference stage never blocks
+        valid_rows, valid_paths, embeddings = item
+        insert_start = time.time()
+        try:
+            with conn_lock:
+                _commit_batch(conn, valid_rows, valid_paths, embeddings, replace, embedding_type)
+        except Exception as e:
+            errors.append(e)
+            continue
+        stats["insert_time"] += time.time() - insert_start
+        stats["rows_inserted"] += len(valid_rows)
+        print(f"Processed {len(valid_rows)} images. rows inserted {stats['rows_inserted']}, checkpoint at id {valid_rows[-1][0]}")
+
+def _commit_batch(conn, valid_rows, valid_paths, embeddings, replace, embedding_type):
+    """Write one batch in its own transaction; each committed batch is a resume point.
+
+    The session's autocommit setting is left alone: on a regular connection
+    the decoder's FETCH may have a transaction open, in which psycopg2 cannot
+    change it. An autocommit connection gets explicit BEGIN/COMMIT instead.
+    """
+    with conn.cursor() as cursor:
+        if conn.autocommit:
+            cursor.execute("BEGIN;")
+        try:
+            if replace:
+                cursor.execute("DELETE FROM products_emb WHERE id = ANY(%s);", ([row[0] for row in valid_rows],))
+            copy_products_emb(cursor, valid_rows, valid_paths, embeddings, embedding_type)
+            if conn.autocommit:
+                cursor.execute("COMMIT;")
+            else:
+                conn.commit()
+        except BaseException:
+            if conn.autocommit:
+                cursor.execute("ROLLBACK;")
+            else:
+                conn.rollback()
+            raise
+
+def load_images_batch(rows, base_path, cache=None):
+    """Read a batch of product images and decode the ones the cache cannot answer.
+
+    Returns (valid_rows, valid_paths, digests, embeddings, cached, inputs):
+    `embeddings` holds the cached vectors where `cached` is set, and `inputs`
+    the CLIP pixel_values of the remaining images (None when every image was
+    cached). Unreadable files are skipped.
+    """
+    valid_rows, valid_paths, datas = [], [], []
+    for row in rows:
+        image_path = f"{base_path}/{row[0]}.jpg"
         try:
-            img = Image.open(image_path)
-            img.verify()  # Verify the image integrity
-            img = Image.open(image_path)  # Reopen to reset file pointer
-            images.append(img)
-            valid_paths.append(image_path)
+            with open(image_path, "rb") as f:
+                datas.append(f.read())
         except OSError as e:
             print(f"Failed to process image {image_path}: {e}")
-            continue  # Skip problematic images
-    if images:
-        return processor(text=[tag] * len(images), images=images, return_tensors="pt", padding=True), valid_paths
+            continue
+        valid_rows.append(row)
+        valid_paths.append(image_path)
+
+    digests = [image_digest(data) for data in datas] if cache is not None else [None] * len(datas)
+    if cache is not None:
+        embeddings, cached = cache.get_many(digests)
     else:
-        return None, []
+        embeddings = np.zeros((len(datas), EMBEDDING_DIM), dtype=np.float32)
+        cached = np.zeros(len(datas), dtype=bool)
+
+    keep, pixels = [], []
+    for i, data in enumerate(datas):
+        if not cached[i]:
+            try:
+                pixels.append(image_loader.decode_image(data))
+            except image_loader.DECODE_ERRORS as e:
+                print(f"Failed to process image {valid_paths[i]}: {e}")
+                continue  # Skip problematic images
+        keep.append(i)
+
+    valid_rows = [valid_rows[i] for i in keep]
+    valid_paths = [valid_paths[i] for i in keep]
+    digests = [digests[i] for i in keep]
+    inputs = {"pixel_values": torch.from_numpy(np.stack(pixels))} if pixels else None
+    return valid_rows, valid_paths, digests, embeddings[keep], cached[keep], inputs
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", help="number of ingestion processes, 1 runs a single in-process pipeline", type=int, default=1)
+    parser.add_argument("--threads-per-worker", help="torch threads per ingestion process (default: cores / workers)", type=int, default=None)
+    parser.add_argument("--batch", help="images per CLIP forward pass", type=int, default=25)
+    parser.add_argument("--cache-dir", help="directory of the persistent embedding cache, reused across rebuilds", type=str, default=None)
+    parser.add_argument("--precision", help="CLIP inference precision, int8 uses dynamic quantization", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--weights-dir", help="CLIP weights exported by shared_weights.py, memory-mapped and shared by all workers", type=str, default=None)
+    parser.add_argument("--embedding-server", help="encode with embedding_server.py at unix:/path or http://host:port instead of a local model", type=str, default=None)
+    parser.add_argument("--ann-index", help="ANN index to build on products_emb.embedding after loading", choices=METHODS + ("none",), default="hnsw")
+    parser.add_argument("--category-indexes", help="also build one partial ANN index per masterCategory for filtered searches", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--incremental", help="only embed products missing from products_emb or changed since, resuming an interrupted run", action="store_true")
+    parser.add_argument("--thumbnail-dir", help="store of the 150px thumbnails the apps display; images not in it yet are added after loading",
+                        type=str, default=os.environ.get("FASHION_THUMBNAIL_DIR", "thumbnails"))
+    parser.add_argument("--thumbnails", help="generate thumbnails after loading", action=argparse.BooleanOptionalAction, default=True)
+    args = parser.parse_args()
+
     start_time = time.time()
     conn = _create_db_connection()
     conn.autocommit = True  # Enable autocommit for creating the database
@@ -104,7 +440,7 @@ def main():
         usage text null,
         productDisplayName TEXT null
         );""")
-    cursor.execute("""CREATE TABLE products_emb (
+    cursor.execute("""CREATE TABLE IF NOT EXISTS products_emb (
         Id integer,
         gender VARCHAR(50),
         masterCategory VARCHAR(100),
@@ -118,15 +454,53 @@ def main():
         Image_path text null, 
         embedding vector(512)
     );""")
-    with open('dataset/stylesc.csv', 'r') as f:
-        next(f)  # Skip the header row
-        with conn.cursor() as cur:
-            cur.copy_expert("COPY products FROM STDIN WITH CSV HEADER", f)
+    cursor.execute("CREATE INDEX IF NOT EXISTS products_id_idx ON products (id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS products_emb_id_idx ON products_emb (id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS products_emb_filters_idx ON products_emb (mastercategory, gender, articletype, season);")
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM products);")
+    if not cursor.fetchone()[0]:
+        with open('dataset/stylesc.csv', 'r') as f:
+            next(f)  # Skip the header row
+            with conn.cursor() as cur:
+                cur.copy_expert("COPY products FROM STDIN WITH CSV HEADER", f)
+    if not args.incremental:
+        # Rebuilt once after the load; maintaining it row by row would slow every insert
+        drop_ann_indexes(conn)
+        cursor.execute("TRUNCATE products_emb;")
     # This will do the same for pgvector use case
-    load_fashion_tag('dataset/images', 'product', 25, conn)
-    conn.close()
+    if args.workers > 1:
+        conn.close()
+        load_fashion_tag_sharded('dataset/images', args.batch, args.workers, args.threads_per_worker, incremental=args.incremental, cache_dir=args.cache_dir, precision=args.precision, weights_dir=args.weights_dir, embedding_server=args.embedding_server)
+    else:
+        load_fashion_tag('dataset/images', 'product', args.batch, conn, incremental=args.incremental, cache_dir=args.cache_dir, precision=args.precision, weights_dir=args.weights_dir, embedding_server=args.embedding_server)
+        conn.close()
     vector_time = time.time() - start_time
     print(f"Creating tables and uploading image files into table took {vector_time:.4f} seconds.")
 
+    if args.thumbnails:
+        # Only images missing from the store are thumbnailed, so incremental loads add just the new ones
+        conn = _create_db_connection()
+        try:
+            build_thumbnails(conn, ThumbnailStore(args.thumbnail_dir), workers=max(1, args.workers))
+        finally:
+            conn.close()
+
+    if args.ann_index != "none":
+        # Incremental loads keep an existing index up to date; it is only built when missing
+        conn = _create_db_connection()
+        # Index builds switch to autocommit; the status query must not leave a transaction open
+        conn.autocommit = True
+        progress_conn = _create_db_connection()
+        progress_conn.autocommit = True
+        try:
+            existing = [name for name, *_ in ann_index_status(conn)]
+            if not args.incremental or index_name(args.ann_index) not in existing:
+                build_ann_index(conn, args.ann_index, progress_conn=progress_conn)
+            if args.category_indexes and (not args.incremental or not any("_cat_" in name for name in existing)):
+                build_partial_indexes(conn, args.ann_index, progress_conn=progress_conn)
+        finally:
+            progress_conn.close()
+            conn.close()
+
 if __name__ == "__main__":
     main()
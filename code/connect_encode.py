@@ -2,6 +2,8 @@ import argparse
 import psycopg2
 import time
 
+from aidb_retrieval import PRODUCTS_IMG_ID_INDEX
+
 
 def _create_db_connection():
         """Create and return a database connection."""
@@ -32,6 +34,8 @@ def initialize_database(conn):
                 productDisplayName TEXT NULL
             );
         """)
+        # Retrieval results are joined to products on img_id
+        cur.execute(PRODUCTS_IMG_ID_INDEX)
 
 def create_and_refresh_retriever(conn, retriever_name, s3_bucket_name, s3_endpoint):
     """Create and refresh the S3 retriever."""
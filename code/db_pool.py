@@ -0,0 +1,64 @@
+import functools
+import hashlib
+import os
+import re
+
+from sqlalchemy import create_engine
+
+# The Streamlit apps create one pool per process with st.cache_resource, shared by
+# every session, instead of an engine per rerun and a psycopg2 connection per session.
+# Searches hold a connection only while their statements run, so a few connections
+# serve many users; past pool_size + max_overflow a search waits up to pool_timeout.
+DEFAULT_POOL_SIZE = int(os.environ.get("FASHION_DB_POOL_SIZE", 10))
+DEFAULT_MAX_OVERFLOW = int(os.environ.get("FASHION_DB_MAX_OVERFLOW", 10))
+DEFAULT_POOL_TIMEOUT = 30
+# Reconnect before server or proxy idle timeouts close the connection under us
+DEFAULT_POOL_RECYCLE = 1800
+
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+def create_pool(database_url, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_MAX_OVERFLOW,
+                pool_timeout=DEFAULT_POOL_TIMEOUT, pool_recycle=DEFAULT_POOL_RECYCLE):
+    """A bounded SQLAlchemy engine whose connections are pinged before each checkout."""
+    return create_engine(
+        database_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=True,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _prepared(sql):
+    # pyformat parameters become $1, $2, ... in order of first use; a repeated name reuses its number
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    body = _PARAMETER.sub(placeholder, sql.strip().rstrip(";"))
+    name = "fashion_" + hashlib.sha1(body.encode()).hexdigest()[:16]
+    arguments = ", ".join(f"%({parameter})s" for parameter in names)
+    return name, body, f"EXECUTE {name}({arguments});" if names else f"EXECUTE {name};"
+
+
+def execute_prepared(connection, sql, params=None):
+    """Run pyformat `sql` on a SQLAlchemy connection as a server-side prepared statement.
+
+    The statement is PREPAREd the first time a pooled connection runs it and
+    then only EXECUTEd, so Postgres parses and plans it once per backend.
+    Parameter types are inferred from the statement, as for an untyped
+    literal. Returns the CursorResult of the EXECUTE.
+    """
+    name, body, execute = _prepared(sql)
+    # Connection.info lives as long as the DBAPI connection, and is reset when the pool reconnects
+    prepared = connection.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        connection.exec_driver_sql(f"PREPARE {name} AS {body}")
+        prepared.add(name)
+    return connection.exec_driver_sql(execute, params) if params else connection.exec_driver_sql(execute)
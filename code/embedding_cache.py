@@ -0,0 +1,138 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 200_000
+
+
+def image_digest(data):
+    """Content address of encoded image bytes."""
+    return hashlib.sha256(data).digest()
+
+
+class EmbeddingCache:
+    """Persistent, size-bounded embedding store keyed by image content.
+
+    Entries live in fixed-capacity memory-mapped arrays under
+    `{path}/{namespace}`, where the namespace is derived from the model name
+    and preprocessing version, so changing either starts a fresh cache. Keys
+    are sha256 digests of the image bytes. When the store is full, the least
+    recently used entries are overwritten.
+
+    Several processes (loader workers, Postgres backends) may share a cache;
+    every operation holds an exclusive lock on the store's lock file and
+    reloads the key index if another process wrote in the meantime.
+    """
+
+    def __init__(self, path, model_name, preprocess_version, dim=512, max_entries=DEFAULT_MAX_ENTRIES):
+        namespace = hashlib.sha256(f"{model_name}|{preprocess_version}|{dim}".encode()).hexdigest()[:16]
+        self.path = os.path.join(path, namespace)
+        os.makedirs(self.path, exist_ok=True)
+        self.dim = dim
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(os.path.join(self.path, "lock"), "a+")
+        with self._locked():
+            self._keys = self._open_array("keys.npy", (max_entries, 32), np.uint8)
+            self._vectors = self._open_array("vectors.npy", (max_entries, dim), np.float32)
+            self._ticks = self._open_array("ticks.npy", (max_entries,), np.int64)
+            # state[0]: generation, bumped on every write; state[1]: LRU clock
+            self._state = self._open_array("state.npy", (2,), np.int64)
+            self._load_index()
+
+    def _open_array(self, name, shape, dtype):
+        filename = os.path.join(self.path, name)
+        if os.path.exists(filename):
+            array = np.load(filename, mmap_mode="r+")
+            if array.shape == shape and array.dtype == dtype:
+                return array
+            # A different capacity or dimension was requested; start over
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        used = np.flatnonzero(self._keys.any(axis=1))
+        self._index = {bytes(self._keys[slot]): int(slot) for slot in used}
+        self._generation = int(self._state[0])
+
+    def _refresh(self):
+        if int(self._state[0]) != self._generation:
+            self._load_index()
+
+    def _tick(self, count):
+        start = int(self._state[1])
+        self._state[1] = start + count
+        return np.arange(start + 1, start + count + 1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_many(self, digests):
+        """Return a (len(digests), dim) float32 array and a boolean mask of cache hits."""
+        vectors = np.zeros((len(digests), self.dim), dtype=np.float32)
+        found = np.zeros(len(digests), dtype=bool)
+        with self._locked():
+            self._refresh()
+            slots = []
+            for i, digest in enumerate(digests):
+                slot = self._index.get(digest)
+                if slot is not None:
+                    found[i] = True
+                    slots.append(slot)
+            if slots:
+                slots = np.array(slots)
+                vectors[found] = self._vectors[slots]
+                self._ticks[slots] = self._tick(len(slots))
+        self.hits += int(found.sum())
+        self.misses += len(digests) - int(found.sum())
+        return vectors, found
+
+    def put_many(self, digests, vectors):
+        """Store embeddings for `digests`, evicting least recently used entries when full."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked():
+            self._refresh()
+            new = {}
+            for digest, vector in zip(digests, vectors):
+                if digest not in self._index:
+                    new[digest] = vector  # Also drops duplicates within the batch
+            new = list(new.items())[: self.max_entries]
+            if not new:
+                return
+            free = np.flatnonzero(self._ticks == 0)[: len(new)]
+            if len(free) < len(new):
+                occupied = np.flatnonzero(self._ticks != 0)
+                needed = len(new) - len(free)
+                oldest = occupied[np.argpartition(self._ticks[occupied], needed - 1)[:needed]]
+                for slot in oldest:
+                    del self._index[bytes(self._keys[slot])]
+                free = np.concatenate([free, oldest])
+            for slot, (digest, vector) in zip(free, new):
+                self._keys[slot] = np.frombuffer(digest, dtype=np.uint8)
+                self._vectors[slot] = vector
+                self._index[digest] = int(slot)
+            self._ticks[free] = self._tick(len(free))
+            self._state[0] += 1
+            self._generation = int(self._state[0])
+
+    def flush(self):
+        for array in (self._keys, self._vectors, self._ticks, self._state):
+            array.flush()
+
+    def close(self):
+        self.flush()
+        self._lock_file.close()
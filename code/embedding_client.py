@@ -0,0 +1,137 @@
+import argparse
+import base64
+import http.client
+import json
+import socket
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+
+CONNECT_RETRIES = 8
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        for attempt in range(CONNECT_RETRIES):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            try:
+                self.sock.connect(self.unix_path)
+                return
+            except BlockingIOError:
+                # EAGAIN: the server's listen backlog is full; wait for it to accept
+                self.sock.close()
+                self.sock = None
+                if attempt == CONNECT_RETRIES - 1:
+                    raise
+                time.sleep(0.005 * 2 ** attempt)
+
+
+class EmbeddingClient:
+    """Client for embedding_server.py, at `unix:/path/to.sock` or `http://host:port`.
+
+    Keeps one connection open and is not thread-safe; use one client per thread.
+    Embeddings are L2-normalized float32 arrays, like clip_model.encode_*.
+    """
+
+    def __init__(self, address, timeout=60):
+        self.address = address
+        self.timeout = timeout
+        self._conn = None
+
+    def _connect(self):
+        if self.address.startswith("unix:"):
+            return UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+        if self.address.startswith("http://"):
+            return http.client.HTTPConnection(self.address[len("http://"):].rstrip("/"), timeout=self.timeout)
+        raise ValueError(f"Unsupported address {self.address!r}, expected unix:/path or http://host:port")
+
+    def _request(self, method, path, body=None, content_type="application/json"):
+        headers = {"Content-Type": content_type} if body is not None else {}
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                self._conn.request(method, path, body, headers)
+                response = self._conn.getresponse()
+                payload = json.loads(response.read())
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed an idle keep-alive connection; reconnect once
+                self.close()
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise RuntimeError(f"Embedding server error {response.status}: {payload.get('error')}")
+        return payload
+
+    def encode_texts(self, texts):
+        """Return a (len(texts), dim) array."""
+        payload = self._request("POST", "/v1/text", json.dumps({"texts": list(texts)}))
+        return np.asarray(payload["embeddings"], dtype=np.float32)
+
+    def encode_images(self, images):
+        """Encode image file bytes; returns a list with None for undecodable images."""
+        body = json.dumps({"images": [base64.b64encode(data).decode() for data in images]})
+        return [
+            None if embedding is None else np.asarray(embedding, dtype=np.float32)
+            for embedding in self._request("POST", "/v1/image", body)["embeddings"]
+        ]
+
+    def encode_pixels(self, pixel_values):
+        """Encode images already preprocessed by image_loader, shape (N, 3, 224, 224)."""
+        buffer = BytesIO()
+        np.save(buffer, np.ascontiguousarray(pixel_values, dtype=np.float32), allow_pickle=False)
+        payload = self._request("POST", "/v1/pixels", buffer.getvalue(), "application/x-npy")
+        return np.asarray(payload["embeddings"], dtype=np.float32)
+
+    def metrics(self):
+        return self._request("GET", "/v1/metrics")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test embedding_server.py with concurrent single-text queries.")
+    parser.add_argument("--address", help="unix:/path/to.sock or http://127.0.0.1:port", default="unix:/tmp/fashion-embeddings.sock")
+    parser.add_argument("--concurrency", help="number of concurrent clients", type=int, default=16)
+    parser.add_argument("--requests", help="queries sent by each client", type=int, default=50)
+    args = parser.parse_args()
+
+    latencies = []
+    lock = threading.Lock()
+
+    def run_client(worker):
+        client = EmbeddingClient(args.address)
+        for i in range(args.requests):
+            start = time.time()
+            client.encode_texts([f"red shoes {worker} {i}"])
+            with lock:
+                latencies.append(time.time() - start)
+        client.close()
+
+    start_time = time.time()
+    threads = [threading.Thread(target=run_client, args=(worker,)) for worker in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.time() - start_time
+
+    print(f"{len(latencies)} queries from {args.concurrency} clients in {total_time:.2f} seconds")
+    print(f"Throughput: {len(latencies) / total_time:.1f} queries/second")
+    print(f"Latency p50: {np.percentile(latencies, 50) * 1000:.1f} ms, p95: {np.percentile(latencies, 95) * 1000:.1f} ms")
+    print(json.dumps(EmbeddingClient(args.address).metrics()["text"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import base64
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import torch
+from transformers import CLIPTokenizer
+
+import image_loader
+from clip_model import MODEL_NAME, PRECISIONS, encode_images, encode_texts, load_clip_model
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# Pending connections the listening socket queues; the kernel caps it at net.core.somaxconn
+LISTEN_BACKLOG = 1024
+
+
+class MicroBatcher:
+    """Coalesce concurrent encode requests into batched forward passes.
+
+    Callers submit a list of inputs and get a Future for their embeddings. A
+    single worker thread takes the oldest request, then keeps collecting
+    requests until `max_batch` inputs are queued or `max_wait` seconds have
+    passed since it started waiting, and runs `encode` once on all of them.
+    An idle server therefore adds at most `max_wait` to a lone request, while
+    a busy one runs full batches.
+    """
+
+    def __init__(self, name, encode, max_batch=32, max_wait=0.005, inference_lock=None):
+        self.name = name
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._inference_lock = inference_lock or threading.Lock()
+        self._queue = queue.Queue()
+        self._pending_items = 0
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.items = 0
+        self.batches = 0
+        self.wait_time = 0.0
+        self.inference_time = 0.0
+        self.batch_sizes = dict.fromkeys(BATCH_SIZE_BUCKETS, 0)
+        self._worker = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, inputs):
+        future = Future()
+        with self._stats_lock:
+            self._pending_items += len(inputs)
+            self.requests += 1
+        self._queue.put((inputs, future, time.time()))
+        return future
+
+    def _collect(self):
+        requests = [self._queue.get()]
+        size = len(requests[0][0])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            size += len(request[0])
+        return requests, size
+
+    def _run(self):
+        while True:
+            requests, size = self._collect()
+            inputs = [item for request_inputs, _, _ in requests for item in request_inputs]
+            start = time.time()
+            try:
+                with self._inference_lock:
+                    embeddings = self.encode(inputs)
+            except Exception as e:
+                for _, future, _ in requests:
+                    future.set_exception(e)
+                embeddings = None
+            end = time.time()
+            with self._stats_lock:
+                self._pending_items -= size
+                self.items += size
+                self.batches += 1
+                self.wait_time += sum(start - queued_at for _, _, queued_at in requests)
+                self.inference_time += end - start
+                bucket = next((b for b in BATCH_SIZE_BUCKETS if size <= b), BATCH_SIZE_BUCKETS[-1])
+                self.batch_sizes[bucket] += 1
+            if embeddings is None:
+                continue
+            offset = 0
+            for request_inputs, future, _ in requests:
+                future.set_result(embeddings[offset:offset + len(request_inputs)])
+                offset += len(request_inputs)
+
+    def metrics(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self._pending_items,
+                "requests": self.requests,
+                "items": self.items,
+                "batches": self.batches,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "mean_queue_wait_ms": 1000 * self.wait_time / self.requests if self.requests else 0.0,
+                "mean_inference_ms": 1000 * self.inference_time / self.batches if self.batches else 0.0,
+                # Bucket b counts batches larger than the previous bucket and at most b; the last one also counts larger batches
+                "batch_size_histogram": {str(b): n for b, n in self.batch_sizes.items()},
+            }
+
+
+class EmbeddingService:
+    """One CLIP model behind a text batcher and an image batcher.
+
+    The two batchers share an inference lock, so text and image forwards take
+    turns on the cores instead of competing for them.
+    """
+
+    def __init__(self, precision="fp32", weights_dir=None, max_batch=32, max_wait=0.005):
+        self.model = load_clip_model(precision, weights_dir=weights_dir)
+        self.tokenizer = CLIPTokenizer.from_pretrained(MODEL_NAME)
+        self.precision = precision
+        inference_lock = threading.Lock()
+        self.text = MicroBatcher("text", self._encode_texts, max_batch, max_wait, inference_lock)
+        self.image = MicroBatcher("image", self._encode_pixels, max_batch, max_wait, inference_lock)
+
+    def _encode_texts(self, texts):
+        return encode_texts(self.model, self.tokenizer, texts).numpy()
+
+    def _encode_pixels(self, pixels):
+        return encode_images(self.model, torch.from_numpy(np.stack(pixels))).numpy()
+
+    def metrics(self):
+        return {"model": MODEL_NAME, "precision": self.precision, "text": self.text.metrics(), "image": self.image.metrics()}
+
+
+class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP:
+
+    POST /v1/text    {"texts": [...]}                 -> {"embeddings": [[...], ...]}
+    POST /v1/image   {"images": [base64 bytes, ...]}  -> {"embeddings": [...]}, null for undecodable images
+    POST /v1/pixels  .npy body, (N, 3, 224, 224) float32 preprocessed by image_loader -> {"embeddings": [...]}
+    GET  /v1/metrics                                  -> queue depth and batching statistics
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/v1/metrics":
+            self._send(200, self.server.service.metrics())
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.path == "/v1/text":
+                texts = json.loads(body)["texts"]
+                embeddings = service.text.submit(texts).result() if texts else []
+                self._send(200, {"embeddings": np.asarray(embeddings).tolist()})
+            elif self.path == "/v1/image":
+                # Decoding happens here, in the request's own thread, so it overlaps with inference
+                positions, pixels = [], []
+                images = json.loads(body)["images"]
+                for i, data in enumerate(images):
+                    try:
+                        pixels.append(image_loader.decode_image(base64.b64decode(data)))
+                        positions.append(i)
+                    except image_loader.DECODE_ERRORS as e:
+                        print(f"Failed to process image {i + 1}: {e}")
+                result = [None] * len(images)
+                if pixels:
+                    for i, embedding in zip(positions, service.image.submit(pixels).result()):
+                        result[i] = embedding.tolist()
+                self._send(200, {"embeddings": result})
+            elif self.path == "/v1/pixels":
+                pixels = np.load(BytesIO(body), allow_pickle=False)
+                embeddings = service.image.submit(list(pixels)).result() if len(pixels) else []
+                self._send(200, {"embeddings": np.asarray(embeddings).tolist()})
+            else:
+                self._send(404, {"error": f"Unknown path {self.path}"})
+        except (KeyError, TypeError, ValueError) as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass  # One line per request would dominate the server's output under load
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    # socketserver listens with a backlog of 5; a burst of clients beyond it fails to connect
+    request_queue_size = LISTEN_BACKLOG
+
+
+class TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+def create_server(address, service):
+    """Listen on `unix:/path/to.sock` or `http://host:port` (host should be a loopback address)."""
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)  # Stale socket from a previous run
+        server = UnixHTTPServer(path, EmbeddingRequestHandler)
+    elif address.startswith("http://"):
+        host, _, port = address[len("http://"):].rstrip("/").rpartition(":")
+        server = TCPHTTPServer((host, int(port)), EmbeddingRequestHandler)
+    else:
+        raise ValueError(f"Unsupported address {address!r}, expected unix:/path or http://host:port")
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CLIP embeddings to the search apps and loaders with dynamic batching.")
+    parser.add_argument("--address", help="unix:/path/to.sock or http://127.0.0.1:port", default="unix:/tmp/fashion-embeddings.sock")
+    parser.add_argument("--precision", help="CLIP inference precision, int8 uses dynamic quantization", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--weights-dir", help="CLIP weights exported by shared_weights.py", type=str, default=None)
+    parser.add_argument("--max-batch", help="largest number of inputs per forward pass", type=int, default=32)
+    parser.add_argument("--max-wait-ms", help="how long a request may wait for others to share its batch", type=float, default=5.0)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    service = EmbeddingService(args.precision, args.weights_dir, args.max_batch, args.max_wait_ms / 1000)
+    print(f"Model loading time: {time.time() - start_time} seconds")
+    server = create_server(args.address, service)
+    print(f"Serving embeddings on {args.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# Preprocessing of openai/clip-vit-base-patch32 (see its preprocessor_config.json)
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32).reshape(3, 1, 1)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32).reshape(3, 1, 1)
+
+# Part of the embedding cache key; bump it whenever the pixels produced below change.
+# sql/load_fashion_tag.sql and sql/generate_embeddings_clip.sql import this module when
+# fashion.code_path is set and otherwise fall back to their own copies of decode_image
+# and this version: change those copies together with this file.
+PREPROCESS_VERSION = "draft-bicubic-centercrop-224-v1"
+
+# Errors PIL raises for unreadable, truncated or oversized images
+DECODE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+
+def load_image(image_path, size=CLIP_IMAGE_SIZE):
+    """Read and decode an image file once; see decode_image."""
+    with open(image_path, "rb") as f:
+        return decode_image(f.read(), size)
+
+
+def decode_image(data, size=CLIP_IMAGE_SIZE):
+    """Decode encoded image bytes into a normalized CHW float32 array.
+
+    JPEGs are decoded at the smallest DCT scale that still covers `size`, so a
+    large catalog image never has to be decoded at full resolution. Decoding
+    errors surface here, in the same pass, as one of DECODE_ERRORS.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (size, size))
+    img = img.convert("RGB")  # Forces the decode; truncated files fail here
+
+    # Resize the shortest edge to `size`, then center crop, like CLIPProcessor
+    width, height = img.size
+    scale = size / min(width, height)
+    resized = (max(size, round(width * scale)), max(size, round(height * scale)))
+    img = img.resize(resized, Image.BICUBIC)
+    left = (resized[0] - size) // 2
+    top = (resized[1] - size) // 2
+    img = img.crop((left, top, left + size, top + size))
+
+    pixels = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return (pixels - CLIP_MEAN) / CLIP_STD
+
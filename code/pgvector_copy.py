@@ -0,0 +1,100 @@
+import io
+import struct
+
+import numpy as np
+
+# PostgreSQL binary COPY framing: signature, flags field and header extension length
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+NULL_FIELD = struct.pack("!i", -1)
+
+PRODUCTS_EMB_COLUMNS = [
+    ("id", "int4"),
+    ("gender", "text"),
+    ("mastercategory", "text"),
+    ("subcategory", "text"),
+    ("articletype", "text"),
+    ("basecolour", "text"),
+    ("season", "text"),
+    ("year", "int4"),
+    ("usage", "text"),
+    ("productdisplayname", "text"),
+    ("image_path", "text"),
+    ("embedding", "bytes"),  # pgvector binary, see encode_vectors
+]
+
+# Column types products_emb.embedding may have (see compact_storage.py)
+EMBEDDING_TYPES = ("vector", "halfvec")
+
+
+def encode_vectors(embeddings):
+    """Encode a (N, dim) array as pgvector binary values, one bytes object per row.
+
+    pgvector's binary format is an int16 dimension, an unused int16 and the
+    components as big-endian float4.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=">f4")
+    prefix = struct.pack("!hh", embeddings.shape[1], 0)
+    return [prefix + row.tobytes() for row in embeddings]
+
+
+def encode_halfvecs(embeddings):
+    """Encode a (N, dim) array as halfvec binary values: like vector, with big-endian float2 components."""
+    embeddings = np.ascontiguousarray(embeddings, dtype=">f2")
+    prefix = struct.pack("!hh", embeddings.shape[1], 0)
+    return [prefix + row.tobytes() for row in embeddings]
+
+
+def _encode_field(value, kind):
+    if value is None:
+        return NULL_FIELD
+    if kind == "int4":
+        data = struct.pack("!i", value)
+    elif kind == "text":
+        data = str(value).encode("utf-8")
+    elif kind == "bytes":
+        data = value  # Already in the column's binary format
+    else:
+        raise ValueError(f"Unsupported binary COPY type: {kind}")
+    return struct.pack("!i", len(data)) + data
+
+
+def copy_binary(cursor, table, columns, rows):
+    """Stream `rows` into `table` with COPY ... FROM STDIN (FORMAT BINARY).
+
+    `columns` is a list of (name, type) pairs where type is "int4", "text" or
+    "bytes" (a value already encoded in the column's binary format).
+    """
+    buf = io.BytesIO()
+    buf.write(COPY_HEADER)
+    field_count = struct.pack("!h", len(columns))
+    kinds = [kind for _, kind in columns]
+    for row in rows:
+        buf.write(field_count)
+        for value, kind in zip(row, kinds):
+            buf.write(_encode_field(value, kind))
+    buf.write(COPY_TRAILER)
+    buf.seek(0)
+    names = ", ".join(name for name, _ in columns)
+    cursor.copy_expert(f"COPY {table} ({names}) FROM STDIN (FORMAT BINARY)", buf)
+
+
+def copy_products_emb(cursor, product_rows, image_paths, embeddings, embedding_type="vector"):
+    """Write products rows with their image paths and float32 embeddings to products_emb.
+
+    `product_rows` are (id, gender, ..., productdisplayname) tuples as selected
+    from products. `embedding_type` is the type of products_emb.embedding,
+    "vector" or "halfvec"; binary COPY does not convert between them.
+    Embeddings are stored L2-normalized, since searches rank by inner product.
+    """
+    if embedding_type not in EMBEDDING_TYPES:
+        raise ValueError(f"Unsupported embedding column type {embedding_type!r}, expected one of {EMBEDDING_TYPES}")
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.where(norms == 0, 1, norms)
+    encoded = encode_halfvecs(embeddings) if embedding_type == "halfvec" else encode_vectors(embeddings)
+    rows = (
+        (*row[:10], image_path, vector)
+        for row, image_path, vector in zip(product_rows, image_paths, encoded)
+    )
+    copy_binary(cursor, "products_emb", PRODUCTS_EMB_COLUMNS, rows)
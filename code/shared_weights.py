@@ -0,0 +1,120 @@
+import argparse
+import json
+import mmap
+import os
+import warnings
+
+import torch
+from safetensors.torch import save_file
+from transformers import CLIPConfig, CLIPModel, CLIPTextModelWithProjection, CLIPVisionModelWithProjection
+
+from clip_model import MODEL_NAME
+
+WEIGHTS_FILE = "model.safetensors"
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+# Backend-wide mappings, so every model loaded from the same file reuses one mmap
+_MAPPED = {}
+
+
+def export_shared_weights(output_dir, model_name=MODEL_NAME):
+    """Write `model_name` as a config plus a single safetensors file for load_shared_model.
+
+    Non-persistent buffers (e.g. position_ids) are included so the loader never
+    has to materialize anything itself.
+    """
+    model = CLIPModel.from_pretrained(model_name)
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    tensors = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    for name, buffer in model.named_buffers():
+        tensors.setdefault(name, buffer.contiguous())
+    save_file(tensors, os.path.join(output_dir, WEIGHTS_FILE), metadata={"model_name": model_name})
+
+
+def _map_weights(path):
+    """Return read-only tensors that view a shared, memory-mapped safetensors file."""
+    path = os.path.realpath(path)
+    if path not in _MAPPED:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = int.from_bytes(mapped[:8], "little")
+        header = json.loads(mapped[8:8 + header_size])
+        header.pop("__metadata__", None)
+        data_start = 8 + header_size
+        tensors = {}
+        with warnings.catch_warnings():
+            # The mapping is read-only on purpose; inference never writes weights
+            warnings.simplefilter("ignore", UserWarning)
+            for name, info in header.items():
+                dtype = _DTYPES[info["dtype"]]
+                begin, end = info["data_offsets"]
+                count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+                tensor = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + begin)
+                tensors[name] = tensor.reshape(info["shape"])
+        _MAPPED[path] = (mapped, tensors)
+    return _MAPPED[path][1]
+
+
+def load_shared_model(weights_dir, component="full"):
+    """Build a CLIP model whose weights are views of a shared read-only mmap.
+
+    Every process that loads the same file maps the same page-cache pages, so
+    weights are resident once per host rather than once per Postgres backend.
+    `component` is "full" (CLIPModel), "text" (CLIPTextModelWithProjection) or
+    "vision" (CLIPVisionModelWithProjection); one exported file serves all
+    three, since they share CLIPModel's parameter names.
+    """
+    config = CLIPConfig.from_pretrained(weights_dir)
+    # Build on the meta device so no weights are allocated before they are replaced
+    with torch.device("meta"):
+        if component == "full":
+            model = CLIPModel(config)
+        elif component == "text":
+            model = CLIPTextModelWithProjection(config.text_config)
+        elif component == "vision":
+            model = CLIPVisionModelWithProjection(config.vision_config)
+        else:
+            raise ValueError(f"Unknown component {component!r}, expected 'full', 'text' or 'vision'")
+
+    expected = {name for name, _ in model.named_parameters()} | {name for name, _ in model.named_buffers()}
+    for name, tensor in _map_weights(os.path.join(weights_dir, WEIGHTS_FILE)).items():
+        if name not in expected:
+            continue  # Belongs to the other tower
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{weights_dir} has no weights for: {', '.join(missing)}")
+    model.eval()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export CLIP weights for sharing across processes via mmap.")
+    parser.add_argument("output_dir", help="directory to write config.json and model.safetensors to")
+    parser.add_argument("--model", help="model to export", default=MODEL_NAME)
+    args = parser.parse_args()
+    export_shared_weights(args.output_dir, args.model)
+    print(f"Exported {args.model} to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import collections
+import io
+import json
+import mmap
+import os
+import threading
+import time
+from multiprocessing import Pool
+
+import psycopg2
+from PIL import Image
+
+from image_loader import DECODE_ERRORS
+
+THUMBNAIL_WIDTH = 150
+FORMATS = ("WEBP", "JPEG")
+DEFAULT_FORMAT = "WEBP"
+DEFAULT_QUALITY = 80
+DEFAULT_CACHE_ENTRIES = 4096
+
+
+def _create_db_connection():
+    return psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+
+
+def make_thumbnail(image_path, width=THUMBNAIL_WIDTH, image_format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY):
+    """Encoded bytes of `image_path` scaled to `width` pixels wide, the size the apps display."""
+    with Image.open(image_path) as img:
+        # Decode JPEGs at the smallest DCT scale that is still wide enough
+        img.draft("RGB", (width, width))
+        img = img.convert("RGB")
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _make_thumbnail(task):
+    image_path, width, image_format, quality = task
+    try:
+        return image_path, make_thumbnail(image_path, width, image_format, quality)
+    except DECODE_ERRORS as e:
+        return image_path, e
+
+
+class ThumbnailStore:
+    """Pre-generated thumbnails packed into one file, with a bounded in-process LRU in front.
+
+    A pack file in `directory` holds the encoded images back to back and
+    `{directory}/thumbnails.json` names the pack and maps each source image
+    path to its (offset, length) in it. The pack is memory-mapped for reads
+    and only appended to, until rebuild() writes a fresh one; the index is
+    replaced atomically, so readers in other processes see either the old
+    or the new set of thumbnails. Images missing from the store are
+    thumbnailed on the fly and only kept in the LRU.
+    """
+
+    def __init__(self, directory, max_entries=DEFAULT_CACHE_ENTRIES, width=THUMBNAIL_WIDTH):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.width = width
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._pack_name = "thumbnails.pack"
+        self._index_path = os.path.join(directory, "thumbnails.json")
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._index = {}
+        self._index_mtime = None
+        self._map = None
+        self._reload()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, image_path):
+        return image_path in self._index
+
+    def _reload(self):
+        # A rebuild may remove the pack named by the index we just read; read the new index then
+        for attempt in range(2):
+            try:
+                mtime = os.stat(self._index_path).st_mtime_ns
+                if mtime == self._index_mtime:
+                    return
+                with open(self._index_path) as f:
+                    index = json.load(f)
+                # Indexes written before rebuild() existed are a bare {path: entry} map
+                pack_name, entries = (index["pack"], index["entries"]) if "entries" in index else ("thumbnails.pack", index)
+                with open(os.path.join(self.directory, pack_name), "rb") as f:
+                    pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+            except FileNotFoundError:
+                if attempt:
+                    return
+                continue
+            break
+        if self._map is not None:
+            self._map.close()
+        self._index, self._pack_name, self._map, self._index_mtime = entries, pack_name, pack_map, mtime
+
+    def _publish(self, pack_name, index):
+        temporary = f"{self._index_path}.{os.getpid()}"
+        with open(temporary, "w") as f:
+            json.dump({"pack": pack_name, "entries": index}, f)
+        os.replace(temporary, self._index_path)
+
+    def get(self, image_path):
+        """Thumbnail bytes for `image_path`, or None if the image cannot be read."""
+        with self._lock:
+            data = self._cache.get(image_path)
+            if data is not None:
+                self._cache.move_to_end(image_path)
+                self.hits += 1
+                return data
+            self.misses += 1
+            entry = self._index.get(image_path)
+            if entry is None:
+                # A load may have added it since; a stat when nothing changed
+                self._reload()
+                entry = self._index.get(image_path)
+            if entry is not None:
+                offset, length = entry
+                data = self._map[offset:offset + length]
+        if data is None:
+            try:
+                data = make_thumbnail(image_path, self.width)
+            except DECODE_ERRORS:
+                return None
+        with self._lock:
+            self._cache[image_path] = data
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return data
+
+    def refresh(self):
+        """Pick up thumbnails another process added since the index was read."""
+        with self._lock:
+            self._reload()
+
+    def add(self, thumbnails):
+        """Append (image path, bytes) pairs to the pack and publish them in the index.
+
+        Only one process may write at a time. A re-added path points to its new
+        bytes; the old ones stay in the pack until rebuild() replaces it.
+        """
+        with self._lock:
+            self._reload()
+            index = dict(self._index)
+            with open(os.path.join(self.directory, self._pack_name), "ab") as pack:
+                offset = pack.tell()
+                for image_path, data in thumbnails:
+                    pack.write(data)
+                    index[image_path] = (offset, len(data))
+                    offset += len(data)
+                pack.flush()
+                os.fsync(pack.fileno())
+            self._publish(self._pack_name, index)
+            self._reload()
+
+    def rebuild(self, thumbnails):
+        """Replace the whole store with (image path, bytes) pairs, in a fresh pack swapped in at the end.
+
+        Until then readers keep the old pack and index; afterwards the old
+        pack is deleted, so rebuilding never grows the store. Only one
+        process may write at a time. Returns the number of thumbnails stored.
+        """
+        pack_name = f"thumbnails-{time.time_ns():x}.pack"
+        index = {}
+        # Written outside the lock: get() keeps serving the old pack meanwhile
+        with open(os.path.join(self.directory, pack_name), "wb") as pack:
+            offset = 0
+            for image_path, data in thumbnails:
+                pack.write(data)
+                index[image_path] = (offset, len(data))
+                offset += len(data)
+            pack.flush()
+            os.fsync(pack.fileno())
+        with self._lock:
+            self._reload()
+            replaced = self._pack_name
+            self._publish(pack_name, index)
+            self._cache.clear()
+            self._reload()
+        if replaced != pack_name:
+            # Readers that still map it keep their pages after the unlink
+            try:
+                os.remove(os.path.join(self.directory, replaced))
+            except FileNotFoundError:
+                pass
+        return len(index)
+
+    def metrics(self):
+        with self._lock:
+            return {"stored": len(self._index), "cached": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def _decoded(results):
+    for image_path, data in results:
+        if isinstance(data, Exception):
+            print(f"Skipping thumbnail of {image_path}: {data}")
+            continue
+        yield image_path, data
+
+
+def build_thumbnails(conn, store, image_format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY, workers=1, rebuild=False, batch=500):
+    """Thumbnail every products_emb image not yet in `store`; returns the count added.
+
+    With `rebuild`, every image is thumbnailed again into a fresh pack that
+    replaces the store's, so stale bytes do not accumulate.
+    """
+    start_time = time.time()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT DISTINCT image_path FROM products_emb WHERE image_path IS NOT NULL ORDER BY 1;")
+        image_paths = [row[0] for row in cursor.fetchall() if rebuild or row[0] not in store]
+    if not conn.autocommit:
+        conn.commit()
+    tasks = [(image_path, store.width, image_format, quality) for image_path in image_paths]
+    added = 0
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap(_make_thumbnail, tasks, chunksize=16) if pool else map(_make_thumbnail, tasks)
+        thumbnails = _decoded(results)
+        if rebuild:
+            added = store.rebuild(thumbnails)
+        else:
+            pending = []
+            for thumbnail in thumbnails:
+                pending.append(thumbnail)
+                if len(pending) >= batch:
+                    store.add(pending)
+                    added += len(pending)
+                    pending = []
+            if pending:
+                store.add(pending)
+                added += len(pending)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print(f"Added {added} thumbnails ({len(store)} stored) in {time.time() - start_time:.1f} seconds")
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate the catalog thumbnails served by the Streamlit apps.")
+    parser.add_argument("directory", help="thumbnail store directory", nargs="?", default=os.environ.get("FASHION_THUMBNAIL_DIR", "thumbnails"))
+    parser.add_argument("--format", choices=FORMATS, default=DEFAULT_FORMAT)
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY)
+    parser.add_argument("--workers", help="thumbnailing processes", type=int, default=os.cpu_count())
+    parser.add_argument("--rebuild", help="regenerate thumbnails already in the store", action="store_true")
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    try:
+        build_thumbnails(conn, ThumbnailStore(args.directory), args.format, args.quality, args.workers, args.rebuild)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import argparse
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+from ann_index import FILTER_COLUMNS, TABLE, validate_filters
+
+DEFAULT_REFRESH_INTERVAL = 60.0
+# Superseded versions are deleted only once this old, so readers that just read the pointer can still open them
+GRACE_PERIOD = 300.0
+LOAD_RETRIES = 3
+METADATA_COLUMNS = ("productdisplayname", "image_path") + FILTER_COLUMNS
+
+
+def _create_db_connection():
+    return psycopg2.connect(
+        dbname="postgres",
+        user="postgres",
+        password="password",
+        host="localhost",
+        port=15432,
+    )
+
+
+def parse_vector(vector):
+    """float32 array from a pgvector text value ("[0.1,...]") or a list."""
+    if isinstance(vector, str):
+        return np.fromstring(vector.strip()[1:-1], dtype=np.float32, sep=",")
+    return np.asarray(vector, dtype=np.float32)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def table_signature(cursor):
+    """Changes whenever products_emb gains, loses or rewrites rows.
+
+    The row count and id range catch loads and truncates; the statistics
+    counters catch in-place updates such as re-embedding.
+    """
+    cursor.execute(
+        f"""
+        SELECT (SELECT count(*) FROM {TABLE} WHERE embedding IS NOT NULL),
+               (SELECT coalesce(max(id), 0) FROM {TABLE}),
+               (SELECT coalesce(n_tup_ins + n_tup_upd + n_tup_del, 0) FROM pg_stat_user_tables WHERE relid = %s::regclass);
+        """,
+        (TABLE,),
+    )
+    return [int(value or 0) for value in cursor.fetchone()]
+
+
+class VectorSnapshot:
+    """Exact in-process cosine search over a memory-mapped copy of products_emb.
+
+    The snapshot lives in `directory` as `embeddings-{version}.npy` (N x 512
+    float32, L2-normalized), `ids-{version}.npy` and `metadata-{version}.json`
+    (display name, image path and filter columns, parallel to the ids).
+    `current.json` names the live version and is replaced atomically, so
+    other processes keep reading a consistent snapshot during a refresh.
+    Writers in different processes are serialized by an flock on
+    `{directory}/.lock`. Searches are one matrix product plus argpartition.
+    """
+
+    def __init__(self, directory, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._state = None
+        self._last_check = 0.0
+        self._load()
+
+    def __len__(self):
+        return 0 if self._state is None else len(self._state["ids"])
+
+    @property
+    def signature(self):
+        return None if self._state is None else self._state["signature"]
+
+    def _load(self):
+        # A writer may replace the pointer and delete old files between our reads; read it again
+        for attempt in range(LOAD_RETRIES):
+            try:
+                return self._load_current()
+            except FileNotFoundError:
+                if attempt == LOAD_RETRIES - 1:
+                    if self._state is None:
+                        raise
+                    # Keep searching the snapshot already mapped
+                    return False
+                time.sleep(0.1)
+
+    def _load_current(self):
+        pointer = os.path.join(self.directory, "current.json")
+        if not os.path.exists(pointer):
+            return False
+        with open(pointer) as f:
+            current = json.load(f)
+        version = current["version"]
+        if self._state is not None and self._state["version"] == version:
+            return False
+        with open(os.path.join(self.directory, f"metadata-{version}.json")) as f:
+            metadata = json.load(f)
+        self._state = {
+            "version": version,
+            "signature": current["signature"],
+            "embeddings": np.load(os.path.join(self.directory, f"embeddings-{version}.npy"), mmap_mode="r"),
+            "ids": np.load(os.path.join(self.directory, f"ids-{version}.npy")),
+            "metadata": {column: np.array(values, dtype=object) for column, values in metadata.items()},
+        }
+        return True
+
+    def _write(self, conn, signature, batch=5000):
+        version = f"{time.time_ns():x}"
+        ids, vectors = [], []
+        metadata = {column: [] for column in METADATA_COLUMNS}
+        with conn.cursor(name="vector_snapshot") as cursor:
+            # Text form works for both vector and halfvec columns
+            cursor.execute(
+                f"SELECT id, embedding::text, {', '.join(METADATA_COLUMNS)} FROM {TABLE} "
+                f"WHERE embedding IS NOT NULL ORDER BY id;"
+            )
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for product_id, embedding, *values in rows:
+                    ids.append(product_id)
+                    vectors.append(parse_vector(embedding))
+                    for column, value in zip(METADATA_COLUMNS, values):
+                        metadata[column].append(value)
+        conn.commit()
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(self.directory, f"embeddings-{version}.npy"), mode="w+", dtype=np.float32,
+            shape=(len(vectors), vectors[0].shape[0] if vectors else 512),
+        )
+        if vectors:
+            embeddings[:] = _normalize(np.stack(vectors))
+        embeddings.flush()
+        del embeddings
+        np.save(os.path.join(self.directory, f"ids-{version}.npy"), np.array(ids, dtype=np.int64))
+        with open(os.path.join(self.directory, f"metadata-{version}.json"), "w") as f:
+            json.dump(metadata, f)
+
+        pointer = os.path.join(self.directory, "current.json")
+        replaced = None
+        if os.path.exists(pointer):
+            with open(pointer) as f:
+                replaced = json.load(f)["version"]
+        temporary = os.path.join(self.directory, f"current.json.{version}")
+        with open(temporary, "w") as f:
+            json.dump({"version": version, "signature": signature, "rows": len(ids)}, f)
+        os.replace(temporary, pointer)
+        if replaced is not None:
+            self._remove_older(replaced)
+
+    def _remove_older(self, replaced):
+        # Only versions the replaced one had already superseded, and only after the grace
+        # period; readers that still map one keep their pages after the unlink
+        cutoff = time.time() - GRACE_PERIOD
+        for path in glob.glob(os.path.join(self.directory, "*-*.*")):
+            version = os.path.basename(path).split("-", 1)[1].split(".", 1)[0]
+            try:
+                if int(version, 16) < int(replaced, 16) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except (ValueError, FileNotFoundError):
+                continue
+
+    @contextlib.contextmanager
+    def _writer_lock(self):
+        with open(os.path.join(self.directory, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refresh(self, conn, force=False):
+        """Rebuild the snapshot if products_emb changed since it was taken; returns True if it was rebuilt."""
+        with self._lock, self._writer_lock():
+            self._last_check = time.monotonic()
+            # Another process may already have written a newer snapshot
+            self._load()
+            with conn.cursor() as cursor:
+                signature = table_signature(cursor)
+            conn.commit()
+            if not force and signature == self.signature:
+                return False
+            start_time = time.time()
+            self._write(conn, signature)
+            self._load()
+            print(f"Snapshot of {len(self)} embeddings written in {time.time() - start_time:.1f} seconds")
+            return True
+
+    def maybe_refresh(self, conn):
+        """refresh() at most once per refresh_interval seconds."""
+        if self._state is None or time.monotonic() - self._last_check >= self.refresh_interval:
+            return self.refresh(conn)
+        return False
+
+    def _mask(self, state, filters):
+        filters = validate_filters(filters)
+        if not filters:
+            return None
+        mask = np.ones(len(state["ids"]), dtype=bool)
+        for column, value in filters.items():
+            mask &= state["metadata"][column] == value
+        return mask
+
+    def _top(self, state, queries, k, filters):
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        scores = queries @ state["embeddings"].T
+        mask = self._mask(state, filters)
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        k = min(k, scores.shape[1] if mask is None else int(mask.sum()))
+        if k <= 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def _current(self):
+        # A refresh swaps the whole state; searches keep the one they started with
+        state = self._state
+        if state is None:
+            raise RuntimeError(f"No snapshot in {self.directory}; call refresh() first")
+        return state
+
+    def search_batch(self, queries, k=10, filters=None):
+        """Top-k of each query as (ids, cosine similarities), two (Q, k) arrays in descending similarity."""
+        state = self._current()
+        positions, scores = self._top(state, queries, k, filters)
+        return state["ids"][positions], scores
+
+    def search(self, query, k=10, filters=None):
+        """Nearest products of one query as dicts shaped like get_similarity_results rows."""
+        state = self._current()
+        positions, scores = self._top(state, parse_vector(query), k, filters)
+        metadata = state["metadata"]
+        return [
+            {
+                "id": int(state["ids"][position]),
+                "name": metadata["productdisplayname"][position],
+                "image_path": metadata["image_path"][position],
+                "distance": float(1 - score),
+            }
+            for position, score in zip(positions[0], scores[0])
+        ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and time the in-process NumPy snapshot of products_emb.")
+    parser.add_argument("command", choices=("refresh", "benchmark"))
+    parser.add_argument("--directory", help="snapshot directory", default=os.environ.get("FASHION_SNAPSHOT_DIR", "embedding_snapshot"))
+    parser.add_argument("--force", help="rebuild even if the table did not change", action="store_true")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", help="catalog items used as queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    conn = _create_db_connection()
+    try:
+        snapshot = VectorSnapshot(args.directory)
+        rebuilt = snapshot.refresh(conn, force=args.force)
+        if args.command == "refresh":
+            if not rebuilt:
+                print(f"Snapshot of {len(snapshot)} embeddings is up to date")
+            return
+        embeddings = snapshot._current()["embeddings"]
+        rows = np.random.default_rng(0).choice(len(snapshot), min(args.queries, len(snapshot)), replace=False)
+        queries = np.asarray(embeddings[np.sort(rows)])
+        start_time = time.perf_counter()
+        for query in queries:
+            snapshot.search_batch(query, args.k)
+        single = (time.perf_counter() - start_time) / len(queries)
+        start_time = time.perf_counter()
+        for offset in range(0, len(queries), args.batch_size):
+            snapshot.search_batch(queries[offset:offset + args.batch_size], args.k)
+        batched = (time.perf_counter() - start_time) / len(queries)
+        print(f"{len(snapshot)} embeddings: {single * 1000:.2f} ms per query, "
+              f"{batched * 1000:.2f} ms per query in batches of {args.batch_size}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
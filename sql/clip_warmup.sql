@@ -0,0 +1,107 @@
+-- Model warm-up, so the first search or load in a new backend does not pay the CLIP load.
+--
+-- public.clip_warmup() loads the text and/or vision towers into GD (shared by
+-- generate_embeddings_clip_* and load_fashion_tag) and runs a dummy forward pass through each.
+-- Call it from the connection pool when a server connection is opened, e.g. in the [databases]
+-- entry of pgbouncer.ini:
+--   postgres = host=localhost port=15432 connect_query='SELECT public.clip_warmup()'
+-- or from a SQLAlchemy "connect" event (see code/app_search_final.py).
+--
+-- select * from public.clip_warmup();
+-- select * from public.clip_model_status();           -- this backend
+-- select * from clip_backend_warmth where not warm;   -- client backends never warmed up
+
+-- One row per backend and model, written by clip_warmup(). Unlogged: it only describes live backends.
+CREATE UNLOGGED TABLE IF NOT EXISTS clip_backend_status (
+    pid integer,
+    backend_start timestamptz,
+    model text,
+    load_seconds double precision,
+    forward_seconds double precision,
+    warmed_at timestamptz,
+    PRIMARY KEY (pid, model)
+);
+
+CREATE OR REPLACE FUNCTION public.clip_warmup(components text[] DEFAULT ARRAY['text', 'vision'])
+RETURNS TABLE(model text, already_loaded boolean, load_seconds double precision, forward_seconds double precision) AS $$
+import time
+from io import BytesIO
+
+from PIL import Image
+
+precision = plpy.execute("SELECT current_setting('fashion.clip_precision', true) AS v")[0]['v'] or 'fp32'
+
+# A blank image is enough to exercise the whole vision tower
+buffer = BytesIO()
+Image.new("RGB", (224, 224)).save(buffer, format="PNG")
+dummy_inputs = {
+    'text': ("SELECT public.generate_embeddings_clip_text($1)", "text[]", ["warm-up"]),
+    'vision': ("SELECT public.generate_embeddings_clip_bytea($1)", "bytea[]", [buffer.getvalue()]),
+}
+
+rows = []
+for component in components:
+    if component not in dummy_inputs:
+        plpy.error(f"Unknown component {component!r}, expected 'text' or 'vision'")
+    query, arg_type, args = dummy_inputs[component]
+    model_key = f'clip_{component}_{precision}'
+    already_loaded = model_key in GD
+    start = time.time()
+    plpy.execute(plpy.prepare(query, [arg_type]), [args])  # Loads the model on first use
+    elapsed = time.time() - start
+    load_seconds = GD['clip_load_times'][model_key][0]
+    # On a cold backend the first call also paid the load, so time a second, warm forward pass
+    forward_start = time.time()
+    plpy.execute(plpy.prepare(query, [arg_type]), [args])
+    forward_seconds = time.time() - forward_start
+    rows.append((model_key, already_loaded, load_seconds, forward_seconds))
+    plpy.notice(f"{model_key}: {'already loaded' if already_loaded else f'loaded in {elapsed:.2f} seconds'}, forward pass {forward_seconds:.3f} seconds")
+
+record_plan = plpy.prepare("""
+    INSERT INTO clip_backend_status (pid, backend_start, model, load_seconds, forward_seconds, warmed_at)
+    SELECT pg_backend_pid(), a.backend_start, $1, $2, $3, now()
+    FROM pg_stat_activity a WHERE a.pid = pg_backend_pid()
+    ON CONFLICT (pid, model) DO UPDATE
+    SET backend_start = EXCLUDED.backend_start, load_seconds = EXCLUDED.load_seconds,
+        forward_seconds = EXCLUDED.forward_seconds, warmed_at = EXCLUDED.warmed_at
+""", ["text", "double precision", "double precision"])
+for model_key, _, load_seconds, forward_seconds in rows:
+    plpy.execute(record_plan, [model_key, load_seconds, forward_seconds])
+# Forget backends that have exited (pids are reused, so backend_start is compared too)
+plpy.execute("""
+    DELETE FROM clip_backend_status s
+    WHERE NOT EXISTS (SELECT 1 FROM pg_stat_activity a WHERE a.pid = s.pid AND a.backend_start = s.backend_start)
+""")
+return rows
+$$ LANGUAGE plpython3u;
+
+-- Load state of this backend's models, whether loaded by clip_warmup() or on first use.
+CREATE OR REPLACE FUNCTION public.clip_model_status()
+RETURNS TABLE(model text, loaded boolean, load_seconds double precision, loaded_at timestamptz) AS $$
+from datetime import datetime, timezone
+
+precision = plpy.execute("SELECT current_setting('fashion.clip_precision', true) AS v")[0]['v'] or 'fp32'
+load_times = GD.get('clip_load_times', {})
+models = [f'clip_text_{precision}', f'clip_vision_{precision}']
+models += sorted(key for key in load_times if key not in models)
+rows = []
+for model_key in models:
+    if model_key in load_times:
+        load_seconds, loaded_at = load_times[model_key]
+        rows.append((model_key, True, load_seconds, datetime.fromtimestamp(loaded_at, timezone.utc).isoformat()))
+    else:
+        rows.append((model_key, False, None, None))
+return rows
+$$ LANGUAGE plpython3u VOLATILE;
+
+-- Client backends of this database and whether clip_warmup() ran in them.
+CREATE OR REPLACE VIEW clip_backend_warmth AS
+SELECT a.pid, a.usename, a.application_name, a.client_addr, a.backend_start,
+       count(s.model) > 0 AS warm,
+       array_agg(s.model ORDER BY s.model) FILTER (WHERE s.model IS NOT NULL) AS models,
+       max(s.load_seconds) AS max_load_seconds,
+       max(s.warmed_at) AS warmed_at
+FROM pg_stat_activity a
+LEFT JOIN clip_backend_status s ON s.pid = a.pid AND s.backend_start = a.backend_start
+WHERE a.backend_type = 'client backend' AND a.datname = current_database()
+GROUP BY a.pid, a.usename, a.application_name, a.client_addr, a.backend_start;
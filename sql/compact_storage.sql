@@ -0,0 +1,72 @@
+-- PCA-reduced embeddings for products_emb. Installed by `python code/compact_storage.py pca`, which
+-- fits the projection from the catalog, adds the embedding_pca column and backfills it; the functions
+-- below reference that column, so install this file only after it exists.
+--
+-- select * from public.search_products_pca(public.generate_embeddings_clip_text('red shoes'), 10, 100);
+
+-- Fitted projections: embedding_pca = (embedding - mean) @ components^T
+CREATE TABLE IF NOT EXISTS embedding_projections (
+    name text PRIMARY KEY,
+    dim_in integer NOT NULL,
+    dim_out integer NOT NULL,
+    mean real[] NOT NULL,
+    components real[] NOT NULL,  -- dim_out x dim_in, row-major
+    explained_variance real,
+    fitted_rows integer,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- embedding is the text form of a vector or halfvec, so both storage modes can call it.
+CREATE OR REPLACE FUNCTION public.pca_project(embedding text, projection text DEFAULT 'products_emb_pca')
+RETURNS halfvec AS $$
+import json
+
+import numpy as np
+
+if 'pca_version_plan' not in GD:
+    GD['pca_version_plan'] = plpy.prepare("SELECT created_at FROM embedding_projections WHERE name = $1", ["text"])
+    GD['pca_load_plan'] = plpy.prepare(
+        "SELECT dim_in, dim_out, mean, components, created_at FROM embedding_projections WHERE name = $1", ["text"])
+    GD['pca_projections'] = {}
+
+# Reload when the projection is refitted, so every backend projects with the current one
+version = plpy.execute(GD['pca_version_plan'], [projection])
+if not version:
+    plpy.error(f"Unknown projection {projection!r}; run code/compact_storage.py pca first")
+cached = GD['pca_projections'].get(projection)
+if cached is None or cached[0] != version[0]['created_at']:
+    row = plpy.execute(GD['pca_load_plan'], [projection])[0]
+    mean = np.array(row['mean'], dtype=np.float32)
+    components = np.array(row['components'], dtype=np.float32).reshape(row['dim_out'], row['dim_in'])
+    cached = (row['created_at'], mean, components)
+    GD['pca_projections'][projection] = cached
+_, mean, components = cached
+
+reduced = components @ (np.array(json.loads(embedding), dtype=np.float32) - mean)
+# Returned as text so PL/Python does not need a halfvec conversion
+return str(reduced.tolist())
+$$ LANGUAGE plpython3u STABLE STRICT;
+
+-- Keeps embedding_pca in step with embedding for every loader, including binary COPY.
+CREATE OR REPLACE FUNCTION products_emb_project_pca()
+RETURNS trigger AS $$
+BEGIN
+    NEW.embedding_pca := public.pca_project(NEW.embedding::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Candidates from the reduced vectors (and their index), re-ranked by exact inner product on the full,
+-- normalized embedding. distance is the cosine distance, 1 + (a <#> b) for unit vectors.
+CREATE OR REPLACE FUNCTION public.search_products_pca(query vector, k integer DEFAULT 10, candidates integer DEFAULT 100)
+RETURNS TABLE(id integer, productdisplayname text, image_path text, distance double precision) AS $$
+    SELECT c.id, c.productdisplayname, c.image_path, 1 + (c.embedding::vector <#> query) AS distance
+    FROM (
+        SELECT e.id, e.productdisplayname, e.image_path, e.embedding
+        FROM products_emb e
+        ORDER BY e.embedding_pca <=> public.pca_project(query::text)
+        LIMIT candidates
+    ) c
+    ORDER BY c.embedding::vector <#> query
+    LIMIT k;
+$$ LANGUAGE sql STABLE;
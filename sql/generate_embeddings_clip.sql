@@ -0,0 +1,151 @@
+-- Query-side CLIP encoders used by the Streamlit apps (app_search_final.py, app_search_adv.py).
+--
+-- The array variants encode many inputs in a single forward pass; the scalar variants wrap them.
+-- Each backend loads the text tower and the vision tower once and keeps them in GD, so every
+-- CLIP function called in that connection shares them. Embeddings are L2-normalized, like the
+-- image embeddings load_fashion_tag stores. SET fashion.clip_precision = 'int8' switches to the
+-- dynamically quantized model. SET fashion.clip_weights_dir (and fashion.code_path, see
+-- load_fashion_tag.sql) maps the weights exported by code/shared_weights.py instead of loading a
+-- private copy, so all backends share one set of read-only pages.
+--
+-- select public.generate_embeddings_clip_text('red shoes');
+-- select public.generate_embeddings_clip_text(ARRAY['red shoes', 'black shoes']);
+
+CREATE OR REPLACE FUNCTION public.generate_embeddings_clip_text(queries text[])
+RETURNS vector[] AS $$
+import sys
+import time
+
+import torch
+from transformers import CLIPTextModelWithProjection, CLIPTokenizer
+
+precision = plpy.execute("SELECT current_setting('fashion.clip_precision', true) AS v")[0]['v'] or 'fp32'
+if precision not in ('fp32', 'int8'):
+    plpy.error(f"fashion.clip_precision must be 'fp32' or 'int8', not {precision!r}")
+
+model_key = f'clip_text_{precision}'
+if model_key not in GD:
+    load_start = time.time()
+    weights_dir = plpy.execute("SELECT current_setting('fashion.clip_weights_dir', true) AS v")[0]['v']
+    if weights_dir:
+        code_path = plpy.execute("SELECT current_setting('fashion.code_path', true) AS v")[0]['v']
+        if code_path and code_path not in sys.path:
+            sys.path.append(code_path)
+        from shared_weights import load_shared_model
+        model = load_shared_model(weights_dir, "text")
+    else:
+        model = CLIPTextModelWithProjection.from_pretrained("openai/clip-vit-base-patch32")
+    model.eval()
+    if precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    GD[model_key] = (CLIPTokenizer.from_pretrained("openai/clip-vit-base-patch32"), model)
+    # Reported by public.clip_model_status(): (load seconds, loaded at)
+    GD.setdefault('clip_load_times', {})[model_key] = (time.time() - load_start, time.time())
+tokenizer, model = GD[model_key]
+
+# NULL queries get NULL embeddings
+positions = [i for i, query in enumerate(queries) if query is not None]
+result = [None] * len(queries)
+if positions:
+    inputs = tokenizer([queries[i] for i in positions], padding=True, truncation=True, return_tensors="pt")
+    with torch.no_grad():
+        embeddings = model.text_projection(model.text_model(**inputs).pooler_output)
+    embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
+    # Returned as text so PL/Python builds a 1-D vector[] rather than a 2-D array
+    for i, embedding in zip(positions, embeddings.tolist()):
+        result[i] = str(embedding)
+return result
+$$ LANGUAGE plpython3u STABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.generate_embeddings_clip_text(query text)
+RETURNS vector AS $$
+    SELECT (public.generate_embeddings_clip_text(ARRAY[query]))[1];
+$$ LANGUAGE sql STABLE STRICT;
+
+
+-- tag is accepted for compatibility with existing callers and ignored: only the vision tower runs.
+CREATE OR REPLACE FUNCTION public.generate_embeddings_clip_bytea(images bytea[], tag text DEFAULT NULL)
+RETURNS vector[] AS $$
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPVisionModelWithProjection
+
+precision = plpy.execute("SELECT current_setting('fashion.clip_precision', true) AS v")[0]['v'] or 'fp32'
+if precision not in ('fp32', 'int8'):
+    plpy.error(f"fashion.clip_precision must be 'fp32' or 'int8', not {precision!r}")
+
+code_path = plpy.execute("SELECT current_setting('fashion.code_path', true) AS v")[0]['v']
+if code_path and code_path not in sys.path:
+    sys.path.append(code_path)
+
+model_key = f'clip_vision_{precision}'
+if model_key not in GD:
+    load_start = time.time()
+    weights_dir = plpy.execute("SELECT current_setting('fashion.clip_weights_dir', true) AS v")[0]['v']
+    if weights_dir:
+        from shared_weights import load_shared_model
+        model = load_shared_model(weights_dir, "vision")
+    else:
+        model = CLIPVisionModelWithProjection.from_pretrained("openai/clip-vit-base-patch32")
+    model.eval()
+    if precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    GD[model_key] = model
+    # Reported by public.clip_model_status(): (load seconds, loaded at)
+    GD.setdefault('clip_load_times', {})[model_key] = (time.time() - load_start, time.time())
+model = GD[model_key]
+
+# Same preprocessing as load_fashion_tag, so query and catalog embeddings are comparable:
+# code/image_loader.py when fashion.code_path is set, otherwise this copy, which must stay
+# identical to it and to the one in load_fashion_tag.sql
+try:
+    from image_loader import decode_image
+except ImportError:
+    CLIP_IMAGE_SIZE = 224
+    CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32).reshape(3, 1, 1)
+    CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32).reshape(3, 1, 1)
+
+    def decode_image(data, size=CLIP_IMAGE_SIZE):
+        img = Image.open(BytesIO(data))
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+        width, height = img.size
+        scale = size / min(width, height)
+        resized = (max(size, round(width * scale)), max(size, round(height * scale)))
+        img = img.resize(resized, Image.BICUBIC)
+        left = (resized[0] - size) // 2
+        top = (resized[1] - size) // 2
+        img = img.crop((left, top, left + size, top + size))
+        pixels = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+        return (pixels - CLIP_MEAN) / CLIP_STD
+
+# NULL or undecodable images get NULL embeddings
+positions, pixels = [], []
+for i, data in enumerate(images):
+    if data is None:
+        continue
+    try:
+        pixels.append(decode_image(data))
+        positions.append(i)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        plpy.warning(f"Failed to process image {i + 1}: {e}")
+
+result = [None] * len(images)
+if positions:
+    with torch.no_grad():
+        embeddings = model.visual_projection(model.vision_model(pixel_values=torch.from_numpy(np.stack(pixels))).pooler_output)
+    embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
+    for i, embedding in zip(positions, embeddings.tolist()):
+        result[i] = str(embedding)
+return result
+$$ LANGUAGE plpython3u STABLE;
+
+CREATE OR REPLACE FUNCTION public.generate_embeddings_clip_bytea(image bytea, tag text DEFAULT NULL)
+RETURNS vector AS $$
+    SELECT (public.generate_embeddings_clip_bytea(ARRAY[image], tag))[1];
+$$ LANGUAGE sql STABLE;
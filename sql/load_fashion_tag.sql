@@ -1,82 +1,248 @@
-CREATE OR REPLACE FUNCTION load_fashion_tag(base_path TEXT, tag text, batch int)
-RETURNS VOID AS $$
+-- The signature changed (incremental mode and id range, rows returned); drop the old one so calls stay unambiguous.
+DROP FUNCTION IF EXISTS load_fashion_tag(text, text, int);
+
+-- incremental: only embed products that are missing from products_emb or whose attributes changed.
+-- id_low / id_high: optional inclusive id range to process. Returns the number of rows inserted.
+CREATE OR REPLACE FUNCTION load_fashion_tag(base_path TEXT, tag text DEFAULT NULL, batch int DEFAULT 32,
+                                            incremental boolean DEFAULT false, id_low int DEFAULT NULL, id_high int DEFAULT NULL)
+RETURNS integer AS $$
+import hashlib
 import os
+import sys
 import time
 from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
+from transformers import CLIPVisionModelWithProjection
 import numpy as np
+import torch
 import io
 from io import BytesIO
 
 # Initialize timing variables for overall function performance tracking
 function_start_time = time.time()
 
-# Load the model and processor with timing
+# CLIP inference precision: 'fp32' (default) or 'int8' (dynamic quantization of the Linear layers),
+# selected with SET fashion.clip_precision = 'int8';
+precision = plpy.execute("SELECT current_setting('fashion.clip_precision', true) AS v")[0]['v'] or 'fp32'
+if precision not in ('fp32', 'int8'):
+    plpy.error(f"fashion.clip_precision must be 'fp32' or 'int8', not {precision!r}")
+# Identifies the model variant in the embedding cache, like model_key() in code/clip_model.py
+model_name = "openai/clip-vit-base-patch32" if precision == 'fp32' else f"openai/clip-vit-base-patch32:{precision}"
+
+# Helper modules from code/ (embedding_cache.py, shared_weights.py, image_loader.py) are found through
+#   SET fashion.code_path = '/path/to/Fashion/code';
+code_path = plpy.execute("SELECT current_setting('fashion.code_path', true) AS v")[0]['v']
+if code_path and code_path not in sys.path:
+    sys.path.append(code_path)
+
+# Load the model with timing. Only the vision tower is needed, so this is the same model
+# generate_embeddings_clip_bytea keeps in GD, and public.clip_warmup() can preload it.
+# With SET fashion.clip_weights_dir = '/path/to/weights' (written by code/shared_weights.py),
+# the fp32 weights are memory-mapped read-only, so every backend shares one copy through the
+# page cache instead of holding its own.
 model_loading_start = time.time()
-if 'model' not in SD or 'processor' not in SD:
-    from transformers import CLIPModel, CLIPProcessor
-    SD['model'] = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    SD['processor'] = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+model_gd_key = f'clip_vision_{precision}'
+if model_gd_key not in GD:
+    weights_dir = plpy.execute("SELECT current_setting('fashion.clip_weights_dir', true) AS v")[0]['v']
+    if weights_dir:
+        from shared_weights import load_shared_model
+        model = load_shared_model(weights_dir, "vision")
+    else:
+        model = CLIPVisionModelWithProjection.from_pretrained("openai/clip-vit-base-patch32")
+    model.eval()
+    if precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    GD[model_gd_key] = model
+    # Reported by public.clip_model_status(): (load seconds, loaded at)
+    GD.setdefault('clip_load_times', {})[model_gd_key] = (time.time() - model_loading_start, time.time())
 model_loading_end = time.time()
 
-model = SD['model']
-processor = SD['processor']
+model = GD[model_gd_key]
+
+# Preprocessing of openai/clip-vit-base-patch32, applied directly in NumPy. With
+# fashion.code_path set it is code/image_loader.py itself; otherwise this copy, which must
+# stay identical to it and to the one in generate_embeddings_clip.sql.
+try:
+    from image_loader import PREPROCESS_VERSION, decode_image
+except ImportError:
+    CLIP_IMAGE_SIZE = 224
+    CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32).reshape(3, 1, 1)
+    CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32).reshape(3, 1, 1)
+    # Embedding cache key component; must match PREPROCESS_VERSION in code/image_loader.py
+    PREPROCESS_VERSION = "draft-bicubic-centercrop-224-v1"
 
-def load_images_batch(batch_ids, base_path, processor, tag):
-    images, valid_paths = [], []
-    for image_id in batch_ids:
-        image_path = f"{base_path}/{image_id}.jpg"
-        #plpy.notice(f"Attempting to load image: {image_path}")
+    def decode_image(data, size=CLIP_IMAGE_SIZE):
+        # Let the JPEG decoder downscale while decoding
+        img = Image.open(BytesIO(data))
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")  # Forces the decode; truncated files fail here
+        width, height = img.size
+        scale = size / min(width, height)
+        resized = (max(size, round(width * scale)), max(size, round(height * scale)))
+        img = img.resize(resized, Image.BICUBIC)
+        left = (resized[0] - size) // 2
+        top = (resized[1] - size) // 2
+        img = img.crop((left, top, left + size, top + size))
+        pixels = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+        return (pixels - CLIP_MEAN) / CLIP_STD
+
+def read_images_batch(rows, base_path):
+    # Read each file once; the bytes are hashed for the cache and decoded on a miss
+    valid_rows, valid_paths, datas = [], [], []
+    for row in rows:
+        image_path = f"{base_path}/{row['id']}.jpg"
         try:
-            img = Image.open(image_path)
-            img.verify()  # Verify the image integrity
-            img = Image.open(image_path)  # Reopen to reset file pointer
-            images.append(img)
-            valid_paths.append(image_path)
+            with open(image_path, "rb") as f:
+                datas.append(f.read())
         except OSError as e:
             plpy.notice(f"Failed to process image {image_path}: {e}")
             continue  # Skip problematic images
-    if images:
-        return processor(text=[tag] * len(images), images=images, return_tensors="pt", padding=True), valid_paths
-    else:
-        return None, []
+        valid_rows.append(row)
+        valid_paths.append(image_path)
+    return valid_rows, valid_paths, datas
+
+# Optional persistent embedding cache shared with code/connect.py, enabled with
+#   SET fashion.embedding_cache_dir = '/path/to/cache';  -- also needs fashion.code_path
+cache = None
+cache_dir = plpy.execute("SELECT current_setting('fashion.embedding_cache_dir', true) AS v")[0]['v']
+if cache_dir:
+    from embedding_cache import EmbeddingCache
+    if SD.get('cache_key') != (cache_dir, model_name):
+        SD['cache'] = EmbeddingCache(cache_dir, model_name, PREPROCESS_VERSION)
+        SD['cache_key'] = (cache_dir, model_name)
+    cache = SD['cache']
+    cache.hits = cache.misses = 0
 
 fetch_start = time.time()
-result = plpy.execute("SELECT id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname FROM products")
+fetch_query = """
+    SELECT p.id, p.gender, p.mastercategory, p.subcategory, p.articletype, p.basecolour, p.season, p.year, p.usage, p.productdisplayname
+    FROM products p
+    WHERE ($1::int IS NULL OR p.id >= $1) AND ($2::int IS NULL OR p.id <= $2)
+"""
+if incremental:
+    # Anti-join: skip products that already have an embedding with identical attributes
+    fetch_query += """
+      AND NOT EXISTS (
+        SELECT 1 FROM products_emb e
+        WHERE e.id = p.id
+          AND (e.gender, e.mastercategory, e.subcategory, e.articletype, e.basecolour, e.season, e.year, e.usage, e.productdisplayname)
+              IS NOT DISTINCT FROM
+              (p.gender, p.mastercategory, p.subcategory, p.articletype, p.basecolour, p.season, p.year, p.usage, p.productdisplayname))
+"""
+fetch_query += " ORDER BY p.id"
+# Stream products through a cursor, one batch at a time, instead of materializing the
+# whole catalog in backend memory. The cursor's snapshot does not see rows this call inserts.
+products_cursor = plpy.cursor(plpy.prepare(fetch_query, ["integer", "integer"]), [id_low, id_high])
 fetch_end = time.time()
 
+# Prepare the insert once per call; each batch is written by a single set-based statement.
+# Embeddings are passed as text and cast to vector so PL/Python does not treat them as a 2-D array.
+insert_plan = plpy.prepare("""
+    INSERT INTO products_emb (id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname, image_path, embedding)
+    SELECT id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname, image_path, embedding::vector
+    FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[], $8::int[], $9::text[], $10::text[], $11::text[], $12::text[])
+        AS t(id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname, image_path, embedding)
+""", ["integer[]", "text[]", "text[]", "text[]", "text[]", "text[]", "text[]", "integer[]", "text[]", "text[]", "text[]", "text[]"])
+
+# In incremental mode stale rows of changed products are replaced, in the same transaction as the insert.
+delete_plan = plpy.prepare("DELETE FROM products_emb WHERE id = ANY($1)", ["integer[]"])
+
+columns = ['id', 'gender', 'mastercategory', 'subcategory', 'articletype', 'basecolour', 'season', 'year', 'usage', 'productdisplayname']
+
 batch_size = batch
-image_count = 0
 total_image_processing_time = 0
 total_insertion_time = 0
 total_rows_inserted = 0
-for i in range(0, len(result), batch_size):
-    batch_ids = [row['id'] for row in result[i:i+batch_size]]
-    inputs, valid_paths = load_images_batch(batch_ids, base_path, processor, tag)
+while True:
     start_time = time.time()  # Record start time
-    if inputs is not None:
+    rows = products_cursor.fetch(batch_size)
+    if not rows:
+        break
+    valid_rows, valid_paths, datas = read_images_batch(rows, base_path)
+    if cache is not None:
+        digests = [hashlib.sha256(data).digest() for data in datas]
+        embeddings, cached = cache.get_many(digests)
+    else:
+        digests = [None] * len(datas)
+        embeddings = np.zeros((len(datas), 512), dtype=np.float32)
+        cached = np.zeros(len(datas), dtype=bool)
+
+    # Decode only the images the cache could not answer
+    keep, pixels = [], []
+    for idx, data in enumerate(datas):
+        if not cached[idx]:
+            try:
+                pixels.append(decode_image(data))
+            except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+                plpy.notice(f"Failed to process image {valid_paths[idx]}: {e}")
+                continue  # Skip problematic images
+        keep.append(idx)
+    if not keep:
+        continue
+    valid_rows = [valid_rows[idx] for idx in keep]
+    valid_paths = [valid_paths[idx] for idx in keep]
+    digests = [digests[idx] for idx in keep]
+    embeddings, cached = embeddings[keep], cached[keep]
+
+    image_processing_time = 0
+    if pixels:
         image_processing_start_time = time.time()
-        outputs = model(**inputs)
-        image_processing_end_time = time.time()
-        embeddings = outputs.image_embeds
-        image_processing_time = image_processing_end_time - image_processing_start_time
+        with torch.no_grad():
+            # Vision tower and projection only; called directly since get_image_features'
+            # return type differs between transformers versions
+            pooled = model.vision_model(pixel_values=torch.from_numpy(np.stack(pixels))).pooler_output
+            computed = model.visual_projection(pooled)
+        # Same normalization CLIPModel.forward applies to its image_embeds output
+        computed = (computed / computed.norm(p=2, dim=-1, keepdim=True)).cpu().numpy()
+        image_processing_time = time.time() - image_processing_start_time
         total_image_processing_time += image_processing_time
+        embeddings[~cached] = computed
+        if cache is not None:
+            cache.put_many([digest for digest, hit in zip(digests, cached) if not hit], computed)
+    embeddings_list = embeddings.tolist()
+
+    insertion_start_time = time.time()
+    if incremental:
+        plpy.execute(delete_plan, [[row['id'] for row in valid_rows]])
+    params = [[row[column] for row in valid_rows] for column in columns]
+    params.append(valid_paths)
+    params.append([str(embedding) for embedding in embeddings_list])
+    plpy.execute(insert_plan, params)
+    insertion_time = time.time() - insertion_start_time
+    total_insertion_time += insertion_time
+    total_rows_inserted += len(valid_rows)
 
-        # Assuming embeddings are processed as a batch; adapt as needed
-        embeddings_list = embeddings.detach().cpu().tolist()
-    counter = 0
-    for idx, embedding in enumerate(embeddings_list):
-        row = result[i+idx]
-        image_path = f"{base_path}/{row['id']}.jpg"
-        #plpy.notice(f"Executing INSERT for ID {row['id']} with data: {row['id'], row['gender'], row['mastercategory'], row['subcategory'], row['articletype'], row['basecolour'], row['season'], row['year'], row['usage'], row['productdisplayname'], image_path, embedding}")
-        # Execute the prepared statement with the current rows data
-        plan = plpy.prepare("insert into products_emb (id, gender, mastercategory, subcategory, articletype, basecolour, season, year, usage, productdisplayname, image_path, embedding) values ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)", ["integer", "text", "text", "text", "text", "text", "text", "integer", "text", "text", "text", "vector"])
-        plpy.execute(plan, [row['id'], row['gender'], row['mastercategory'], row['subcategory'], row['articletype'], row['basecolour'], row['season'], row['year'], row['usage'], row['productdisplayname'], image_path, embedding])
-        image_count += len(valid_paths) 
-        total_rows_inserted += 1
     elapsed_time = time.time() - start_time
-    plpy.notice(f"Processed {batch} images in {elapsed_time} seconds. rows inserted {total_rows_inserted}")
+    plpy.notice(f"Processed {len(valid_rows)} images in {elapsed_time} seconds (inference {image_processing_time} seconds, insert {insertion_time} seconds). rows inserted {total_rows_inserted}")
+products_cursor.close()
 function_end_time = time.time()
 total_time = function_end_time - function_start_time
-plpy.notice(f"Total Rows: {total_rows_inserted} Total function execution time: {total_time} seconds. Model loading time: {model_loading_end - model_loading_start} seconds. Fetching time: {fetch_end - fetch_start} seconds.")
+plpy.notice(f"Total Rows: {total_rows_inserted} Total function execution time: {total_time} seconds. Model loading time: {model_loading_end - model_loading_start} seconds. Fetching time: {fetch_end - fetch_start} seconds. Inference time: {total_image_processing_time} seconds. Insert time: {total_insertion_time} seconds.")
+if cache is not None:
+    cache.flush()
+    plpy.notice(f"Embedding cache: {cache.hits} hits, {cache.misses} misses")
+return total_rows_inserted
 $$ LANGUAGE plpython3u;
+
+-- Resumable load: embeds pending products in chunks of checkpoint_rows ids and commits after each chunk.
+-- After an interruption, CALL it again: committed chunks have nothing pending and are skipped.
+-- CALL load_fashion_tag_checkpointed('dataset/images');
+CREATE OR REPLACE PROCEDURE load_fashion_tag_checkpointed(base_path TEXT, batch int DEFAULT 32, checkpoint_rows int DEFAULT 1024)
+LANGUAGE plpgsql AS $$
+DECLARE
+    chunk record;
+    inserted integer;
+    total integer := 0;
+BEGIN
+    FOR chunk IN
+        SELECT min(id) AS id_low, max(id) AS id_high
+        FROM (SELECT id, (row_number() OVER (ORDER BY id) - 1) / checkpoint_rows AS chunk_no FROM products) s
+        GROUP BY chunk_no
+        ORDER BY chunk_no
+    LOOP
+        inserted := load_fashion_tag(base_path, NULL, batch, true, chunk.id_low, chunk.id_high);
+        COMMIT;
+        total := total + inserted;
+        RAISE NOTICE 'Checkpoint committed through id %, rows inserted %', chunk.id_high, total;
+    END LOOP;
+END;
+$$;
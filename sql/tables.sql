@@ -13,6 +13,12 @@ CREATE TABLE products_emb (
     Image_path text null, 
     embedding vector(512)
 );
+-- Lets incremental loads anti-join products against products_emb without scanning it
+CREATE INDEX products_emb_id_idx ON products_emb (id);
+-- Exact scans for filtered searches on categories too small for their own ANN index
+CREATE INDEX products_emb_filters_idx ON products_emb (mastercategory, gender, articletype, season);
+-- The ANN indexes on embedding are built after loading, sized from the table:
+--   python code/ann_index.py build && python code/ann_index.py build --per-category
 
 drop table if exists products;
 CREATE TABLE products(
@@ -27,3 +33,4 @@ CREATE TABLE products(
     usage text null,
     productDisplayName TEXT null
 );
+CREATE INDEX products_id_idx ON products (id);